@@ -0,0 +1,72 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .graph import Graph
+
+
+# Bump when the cached arrays change meaning
+CACHE_VERSION = 3
+
+TIED_VERTEX_IDS = 'tied_vertex_ids'
+
+
+def fingerprint(*parts) -> str:
+    """
+    Hash of the inputs a cached graph was built from. NumPy arrays are hashed
+    by content, anything else by its ``repr``.
+    """
+    digest = hashlib.sha1(f'v{CACHE_VERSION}'.encode())
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(str(part.dtype).encode())
+            digest.update(str(part.shape).encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+def load_graph(cache_dir: str, key: str) -> Optional[Tuple[Graph, np.ndarray]]:
+    """
+    Memory map a graph and its tied vertex ids saved by ``save_graph``.
+    Returns None if there is no graph cached for ``key``.
+    """
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+
+    arrays = {}
+    for filename in os.listdir(path):
+        name, ext = os.path.splitext(filename)
+        if ext == '.npy':
+            arrays[name] = np.load(os.path.join(path, filename), mmap_mode='r')
+
+    tied_vertex_ids = arrays.pop(TIED_VERTEX_IDS, None)
+    if tied_vertex_ids is None or any(name not in arrays for name in Graph.ARRAYS):
+        return None
+    return Graph.from_arrays(arrays), tied_vertex_ids
+
+
+def save_graph(cache_dir: str, key: str, graph: Graph, tied_vertex_ids: np.ndarray):
+    """
+    Save the graph arrays as ``.npy`` files in a directory named by ``key``.
+    The directory is written under a temporary name and renamed when complete
+    so that an interrupted write is never loaded.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=f'.{key}-', dir=cache_dir)
+    try:
+        arrays = graph.to_arrays()
+        arrays[TIED_VERTEX_IDS] = tied_vertex_ids
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, f'{name}.npy'), np.asarray(array))
+        os.replace(tmp_path, os.path.join(cache_dir, key))
+    except OSError:
+        # e.g. another run already cached the same graph
+        shutil.rmtree(tmp_path, ignore_errors=True)
@@ -0,0 +1,499 @@
+import math
+
+from heapq import heappop, heappush
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from .spatial import expand_ranges
+
+
+class Graph:
+    """
+    Directed routing graph held as compressed sparse row (CSR) arrays.
+
+    Edges keep the numbering they were created with (e.g. the edge ids of a
+    ``QgsGraph`` built from the graph) so that shortest path trees can be
+    mapped back onto the network through ``edge_fid`` and ``edge_segment``.
+    The CSR arrays list the outgoing edges of vertex ``v`` at
+    ``offsets[v]:offsets[v + 1]``.
+    """
+
+    def __init__(
+        self,
+        vertex_count: int,
+        edge_from: np.ndarray,
+        edge_to: np.ndarray,
+        edge_length: np.ndarray,
+        edge_fid: np.ndarray,
+        vertex_xy: Optional[np.ndarray] = None,
+        edge_segment: Optional[np.ndarray] = None,
+    ):
+        self.vertex_count = int(vertex_count)
+        self.edge_from = np.asarray(edge_from, dtype=np.int64)
+        self.edge_to = np.asarray(edge_to, dtype=np.int64)
+        self.edge_length = np.asarray(edge_length, dtype=np.float64)
+        self.edge_fid = np.asarray(edge_fid, dtype=np.int64)
+        # Index of the first vertex of the network segment an edge lies on
+        self.edge_segment = (
+            np.zeros(len(self.edge_fid), dtype=np.int64)
+            if edge_segment is None
+            else np.asarray(edge_segment, dtype=np.int64)
+        )
+        self.vertex_xy = vertex_xy
+
+        self.edges = np.argsort(self.edge_from, kind='stable')
+        self.offsets = np.zeros(self.vertex_count + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(self.edge_from, minlength=self.vertex_count),
+            out=self.offsets[1:],
+        )
+        self.targets = self.edge_to[self.edges]
+        self.lengths = self.edge_length[self.edges]
+
+        self._adjacency = None
+
+    ARRAYS = (
+        'edge_from',
+        'edge_to',
+        'edge_length',
+        'edge_fid',
+        'edge_segment',
+        'edges',
+        'offsets',
+        'targets',
+        'lengths',
+    )
+
+    @property
+    def edge_count(self) -> int:
+        return len(self.edge_from)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        All arrays needed to restore the graph with ``from_arrays``.
+        """
+        arrays = {name: getattr(self, name) for name in self.ARRAYS}
+        if self.vertex_xy is not None:
+            arrays['vertex_xy'] = self.vertex_xy
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> 'Graph':
+        """
+        Restore a graph from ``to_arrays`` without copying or recomputing the
+        CSR layout, e.g. from shared or memory mapped arrays.
+        """
+        graph = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(graph, name, arrays[name])
+        graph.vertex_xy = arrays.get('vertex_xy')
+        graph.vertex_count = len(graph.offsets) - 1
+        graph._adjacency = None
+        return graph
+
+    def adjacency(self) -> Tuple[list, list, list, list]:
+        """
+        CSR arrays as Python lists, which are much faster than NumPy arrays
+        for the element wise access done in the Dijkstra loop.
+        """
+        if self._adjacency is None:
+            self._adjacency = (
+                self.offsets.tolist(),
+                self.edges.tolist(),
+                self.targets.tolist(),
+                self.lengths.tolist(),
+            )
+        return self._adjacency
+
+
+def build_graph(
+    segment_xy: np.ndarray,
+    segment_fid: np.ndarray,
+    segment_index: np.ndarray,
+    point_segment: np.ndarray,
+    point_xy: np.ndarray,
+    measure: Callable[[np.ndarray, np.ndarray], np.ndarray] = None,
+) -> Tuple[Graph, np.ndarray]:
+    """
+    Build a routing graph, with edges in both directions, from network line
+    segments split at the points tied to them.
+
+    Segment ends with identical coordinates are joined into one vertex. The
+    network fid and segment index of every edge are recorded as it is
+    created.
+
+    :param segment_xy: one ``x0, y0, x1, y1`` row per segment
+    :param segment_fid: network feature id of each segment
+    :param segment_index: index of the first vertex of the segment within its
+        feature
+    :param point_segment: row of the segment each point is tied to
+    :param point_xy: location of each point on its segment
+    :param measure: function returning the lengths between two arrays of
+        coordinates, planar distance by default
+    :return: the graph and the vertex id of each tied point
+    """
+    segment_n = len(segment_fid)
+    segment_xy = np.asarray(segment_xy, dtype=np.float64).reshape(-1, 4)
+    point_segment = np.asarray(point_segment, dtype=np.int64)
+    point_xy = np.asarray(point_xy, dtype=np.float64).reshape(-1, 2)
+
+    # Position of the tied points along their segments
+    start = segment_xy[point_segment, :2]
+    delta = segment_xy[point_segment, 2:] - start
+    length2 = np.einsum('ij,ij->i', delta, delta)
+    t = np.einsum('ij,ij->i', point_xy - start, delta) / np.where(
+        length2 > 0, length2, 1.0
+    )
+    t = np.clip(t, 0.0, 1.0)
+
+    # Segment starts, tied points and segment ends, ordered along each segment
+    on_segment = np.concatenate(
+        (np.arange(segment_n), point_segment, np.arange(segment_n))
+    )
+    position = np.concatenate((np.zeros(segment_n), t, np.ones(segment_n)))
+    xy = np.concatenate((segment_xy[:, :2], point_xy, segment_xy[:, 2:]))
+    vertex_xy, vertex_ids = np.unique(xy, axis=0, return_inverse=True)
+    vertex_ids = vertex_ids.reshape(-1)
+
+    order = np.lexsort((position, on_segment))
+    a, b = order[:-1], order[1:]
+    keep = (on_segment[a] == on_segment[b]) & (vertex_ids[a] != vertex_ids[b])
+    a, b = a[keep], b[keep]
+
+    if measure is None:
+        length = np.hypot(*(xy[b] - xy[a]).T)
+    else:
+        length = measure(xy[a], xy[b])
+    segment = on_segment[a]
+
+    graph = Graph(
+        len(vertex_xy),
+        edge_from=np.concatenate((vertex_ids[a], vertex_ids[b])),
+        edge_to=np.concatenate((vertex_ids[b], vertex_ids[a])),
+        edge_length=np.concatenate((length, length)),
+        edge_fid=np.tile(np.asarray(segment_fid)[segment], 2),
+        vertex_xy=vertex_xy,
+        edge_segment=np.tile(np.asarray(segment_index)[segment], 2),
+    )
+    return graph, vertex_ids[segment_n : segment_n + len(point_segment)]
+
+
+class Contraction:
+    """
+    A graph with its chains of degree two vertices contracted into single
+    edges, for shortest path trees with fewer vertices to settle.
+
+    A vertex is contracted when it joins exactly two other vertices with an
+    edge in each direction and is not protected, e.g. tied to a point. Edge
+    ``e`` of the contracted ``graph`` runs along the edges
+    ``chain_edges[chain_ptr[e] : chain_ptr[e + 1]]`` of the full graph, in
+    order, and contracted vertex ``v`` is vertex ``vertices[v]`` of the full
+    graph. Trees of the contracted graph are expanded to trees of the full
+    graph with ``expand``, so routes are still mapped back onto the network
+    through the edges of the full graph.
+    """
+
+    ARRAYS = ('vertices', 'chain_ptr', 'chain_edges')
+
+    def __init__(
+        self,
+        graph: Graph,
+        vertices: np.ndarray,
+        chain_ptr: np.ndarray,
+        chain_edges: np.ndarray,
+    ):
+        self.graph = graph
+        self.vertices = vertices
+        self.chain_ptr = chain_ptr
+        self.chain_edges = chain_edges
+
+    @classmethod
+    def from_graph(cls, graph: Graph, protected: np.ndarray) -> 'Contraction':
+        """
+        Contract the chains of ``graph``, keeping the vertices ``protected``.
+        """
+        out_edges = graph.edges
+        in_edges = np.argsort(graph.edge_to, kind='stable')
+        in_offsets = np.zeros(graph.vertex_count + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(graph.edge_to, minlength=graph.vertex_count),
+            out=in_offsets[1:],
+        )
+
+        # Vertices with two outgoing edges to two other vertices, which have
+        # the incoming edges
+        chained = (np.diff(graph.offsets) == 2) & (np.diff(in_offsets) == 2)
+        chained[np.asarray(protected, dtype=np.int64)] = False
+        candidates = np.flatnonzero(chained)
+        first, second = graph.offsets[candidates], graph.offsets[candidates] + 1
+        targets = np.sort(
+            np.stack((graph.targets[first], graph.targets[second]), axis=1), axis=1
+        )
+        sources = np.sort(
+            np.stack(
+                (
+                    graph.edge_from[in_edges[in_offsets[candidates]]],
+                    graph.edge_from[in_edges[in_offsets[candidates] + 1]],
+                ),
+                axis=1,
+            ),
+            axis=1,
+        )
+        chained[candidates] = (
+            (targets[:, 0] != targets[:, 1])
+            & np.all(targets != candidates[:, None], axis=1)
+            & np.all(targets == sources, axis=1)
+        )
+
+        # The edge leaving the far side of the chained vertex each edge ends at
+        next_edge = np.full(graph.edge_count, -1, dtype=np.int64)
+        into = np.flatnonzero(chained[graph.edge_to])
+        offset = graph.offsets[graph.edge_to[into]]
+        back = graph.targets[offset] == graph.edge_from[into]
+        next_edge[into] = out_edges[offset + back]
+
+        # Chains start at the edges leaving the vertices that are kept, and
+        # are followed one edge at a time
+        starts = np.flatnonzero(~chained[graph.edge_from])
+        chains = np.arange(len(starts))
+        edges = starts
+        chain_parts = []
+        edge_parts = []
+        while len(edges):
+            chain_parts.append(chains)
+            edge_parts.append(edges)
+            on_chain = chained[graph.edge_to[edges]]
+            chains = chains[on_chain]
+            edges = next_edge[edges[on_chain]]
+        chains = np.concatenate(chain_parts)
+        order = np.argsort(chains, kind='stable')
+        chain_edges = np.concatenate(edge_parts)[order]
+        chain_ptr = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(chains, minlength=len(starts)), out=chain_ptr[1:])
+
+        vertices = np.flatnonzero(~chained)
+        vertex_map = np.full(graph.vertex_count, -1, dtype=np.int64)
+        vertex_map[vertices] = np.arange(len(vertices))
+        contracted = Graph(
+            len(vertices),
+            edge_from=vertex_map[graph.edge_from[starts]],
+            edge_to=vertex_map[graph.edge_to[chain_edges[chain_ptr[1:] - 1]]],
+            edge_length=np.bincount(
+                chains[order],
+                weights=graph.edge_length[chain_edges],
+                minlength=len(starts),
+            ),
+            edge_fid=graph.edge_fid[starts],
+            vertex_xy=None if graph.vertex_xy is None else graph.vertex_xy[vertices],
+            edge_segment=graph.edge_segment[starts],
+        )
+        return cls(contracted, vertices, chain_ptr, chain_edges)
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """
+        All arrays needed to restore the contraction with ``from_arrays``.
+        """
+        arrays = {
+            f'graph_{name}': array for name, array in self.graph.to_arrays().items()
+        }
+        arrays.update({name: getattr(self, name) for name in self.ARRAYS})
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> 'Contraction':
+        graph = Graph.from_arrays(
+            {
+                name[len('graph_') :]: array
+                for name, array in arrays.items()
+                if name.startswith('graph_')
+            }
+        )
+        return cls(graph, *(arrays[name] for name in cls.ARRAYS))
+
+    def vertex_id(self, vertex_id: int) -> int:
+        """
+        Contracted vertex id of a vertex of the full graph that is kept.
+        """
+        return int(np.searchsorted(self.vertices, vertex_id))
+
+    def expand(
+        self, graph: Graph, tree: np.ndarray, cost: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Tree and cost of the full ``graph`` from those of the contracted
+        graph, as returned by ``dijkstra``. The vertices along the tree edges
+        are reached through the edges of their chains.
+        """
+        tree = np.asarray(tree, dtype=np.int64)
+        cost = np.asarray(cost, dtype=np.float64)
+        reached = np.flatnonzero(tree != -1)
+        chains = tree[reached]
+        counts = self.chain_ptr[chains + 1] - self.chain_ptr[chains]
+        edges = self.chain_edges[expand_ranges(self.chain_ptr[chains], counts)]
+
+        # Cost along each chain from the cost of its first vertex
+        lengths = np.cumsum(graph.edge_length[edges])
+        chain_start = np.cumsum(counts) - counts
+        start_cost = (
+            cost[self.graph.edge_from[chains]] - np.append(0.0, lengths)[chain_start]
+        )
+
+        full_tree = np.full(graph.vertex_count, -1, dtype=np.int64)
+        full_tree[graph.edge_to[edges]] = edges
+        full_cost = np.full(graph.vertex_count, math.inf)
+        full_cost[graph.edge_to[edges]] = np.repeat(start_cost, counts) + lengths
+        full_cost[self.vertices] = cost
+        return full_tree, full_cost
+
+    def dijkstra(
+        self, graph: Graph, source: int, cutoff: float = math.inf
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        ``dijkstra`` from vertex ``source`` of the full ``graph``, calculated
+        on the contracted graph.
+        """
+        tree, cost = dijkstra(self.graph, self.vertex_id(source), cutoff)
+        return self.expand(graph, tree, cost)
+
+
+def dijkstra(
+    graph: Graph, source: int, cutoff: float = math.inf
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    One to many shortest paths from ``source`` using a binary heap.
+
+    Returns ``(tree, cost)`` like ``QgsGraphAnalyzer.dijkstra``: ``tree[v]`` is
+    the id of the edge used to reach vertex ``v`` (-1 for the source and for
+    unreachable vertices) and ``cost[v]`` the distance to it (inf if
+    unreachable). Vertices further away than ``cutoff`` are never expanded and
+    are reported as unreachable.
+    """
+    offsets, edges, targets, lengths = graph.adjacency()
+
+    cost = [math.inf] * graph.vertex_count
+    tree = [-1] * graph.vertex_count
+    cost[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        d, u = heappop(heap)
+        if d > cost[u]:
+            continue
+        for k in range(offsets[u], offsets[u + 1]):
+            v = targets[k]
+            dv = d + lengths[k]
+            if dv < cost[v] and dv <= cutoff:
+                cost[v] = dv
+                tree[v] = edges[k]
+                heappush(heap, (dv, v))
+
+    return np.array(tree, dtype=np.int64), np.array(cost, dtype=np.float64)
+
+
+def tree_depth(parent: np.ndarray) -> np.ndarray:
+    """
+    Number of edges from the root to each vertex of a tree given as parent
+    vertex ids (-1 for roots and vertices outside the tree). Computed by
+    pointer jumping, i.e. in O(V log depth) vectorized steps.
+    """
+    in_tree = parent != -1
+    depth = in_tree.astype(np.int64)
+    ancestor = np.where(in_tree, parent, np.arange(len(parent)))
+    while True:
+        next_ancestor = ancestor[ancestor]
+        if np.array_equal(next_ancestor, ancestor):
+            return depth
+        depth += depth[ancestor]
+        ancestor = next_ancestor
+
+
+def connected_components(graph: Graph) -> np.ndarray:
+    """
+    Label of the connected component of each vertex, ignoring the direction
+    of the edges. The label is the smallest vertex id in the component.
+
+    The components are merged edge by edge in a union-find forest with path
+    halving, rooted at their smallest vertex, which is close to linear in
+    the number of edges. The labels are then read off by pointer jumping.
+    """
+    parent = list(range(graph.vertex_count))
+    for u, v in zip(graph.edge_from.tolist(), graph.edge_to.tolist()):
+        while parent[u] != u:
+            parent[u] = parent[parent[u]]
+            u = parent[u]
+        while parent[v] != v:
+            parent[v] = parent[parent[v]]
+            v = parent[v]
+        if u < v:
+            parent[v] = u
+        elif v < u:
+            parent[u] = v
+
+    labels = np.array(parent, dtype=np.int64)
+    while True:
+        next_labels = labels[labels]
+        if np.array_equal(next_labels, labels):
+            return labels
+        labels = next_labels
+
+
+def tree_flows(
+    graph: Graph, tree: np.ndarray, vertices: np.ndarray, weights: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Accumulate flows on a shortest path tree from ``dijkstra``.
+
+    ``weights`` (one row per entry in ``vertices``, one column per flow type)
+    are the flows ending at each destination vertex. They are pushed from the
+    leaves towards the root one tree level at a time, so that every tree edge
+    carries the sum of the flows of all routes passing it, in O(V) per tree
+    rather than the summed length of all routes.
+
+    A network feature split into several consecutive graph edges is counted
+    once per route, only the edge closest to the root of such a run gets the
+    flow. Returns the ids of the edges carrying flow and their flows.
+    """
+    reached = np.flatnonzero(tree != -1)
+    reached_edges = tree[reached]
+    parent = np.full(graph.vertex_count, -1, dtype=np.int64)
+    parent[reached] = graph.edge_from[reached_edges]
+
+    flow = np.zeros((graph.vertex_count, weights.shape[1]))
+    np.add.at(flow, vertices, weights)
+
+    # Deepest vertices first, the flow of each level is added to its parents
+    depth = tree_depth(parent)[reached]
+    order = np.argsort(-depth, kind='stable')
+    levels = np.flatnonzero(np.diff(depth[order])) + 1
+    for level in np.split(reached[order], levels):
+        np.add.at(flow, parent[level], flow[level])
+
+    parent_edges = tree[parent[reached]]
+    head = (parent_edges == -1) | (
+        graph.edge_fid[parent_edges] != graph.edge_fid[reached_edges]
+    )
+    head &= np.any(flow[reached] != 0, axis=1)
+    return reached_edges[head], flow[reached[head]]
+
+
+def tree_paths(
+    graph: Graph, tree: np.ndarray, vertices: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Edges of the paths from the root of a tree from ``dijkstra`` to each of
+    ``vertices``. All paths are followed towards the root at once, one edge
+    per step, so the steps are bounded by the depth of the tree. Returns the
+    index into ``vertices`` and the id of every path edge.
+    """
+    paths = np.arange(len(vertices))
+    edges = tree[vertices]
+    path_parts = [paths[:0]]
+    edge_parts = [edges[:0]]
+    while len(paths):
+        on_path = edges != -1
+        paths = paths[on_path]
+        edges = edges[on_path]
+        path_parts.append(paths)
+        edge_parts.append(edges)
+        edges = tree[graph.edge_from[edges]]
+    return np.concatenate(path_parts), np.concatenate(edge_parts)
@@ -0,0 +1,193 @@
+import json
+
+from typing import Tuple
+
+import numpy as np
+
+from . import params
+from .params import MAX_DISTANCE_M
+
+
+CATEGORIES = tuple(sorted(params.poi_categories))
+MODES = ('bike', 'ebike')
+
+
+# P_m(d)
+def sigmoid(b: np.ndarray, d: np.ndarray) -> np.ndarray:
+    """
+    Sigmoid fuction for mode choice, ``b`` holds one row of ``b0, b1, b2, b3``
+    per distance in ``d``
+    """
+    # TODO: Check that this is the correct scaling
+    d = np.asarray(d, dtype=np.float64) / MAX_DISTANCE_M
+    b0, b1, b2, b3 = np.asarray(b, dtype=np.float64).T
+    with np.errstate(over='ignore'):
+        return 1 / (1 + np.exp(-(b0 + b1 * d + b2 * d ** 2 + b3 * np.sqrt(d))))
+
+
+class Model:
+    """
+    Destination and mode choice model with the parameters from ``params`` as
+    arrays indexed like ``CATEGORIES`` (and ``MODES``), so that all routes of
+    an origin are evaluated at once.
+    """
+
+    def __init__(
+        self,
+        poi_gravity_values: dict = params.poi_gravity_values,
+        trip_generation: dict = params.trip_generation,
+        mode_params_bike: dict = params.mode_params_bike,
+        mode_params_ebike: dict = params.mode_params_ebike,
+        mode_split: dict = params.mode_split,
+    ):
+        # Beta_p
+        self.gravity = np.array([poi_gravity_values[cat] for cat in CATEGORIES])
+        # T_p
+        self.trip_generation = np.array([trip_generation[cat] for cat in CATEGORIES])
+        # Sigmoid parameters per mode and category
+        self.mode_params = np.array(
+            [
+                [mode_params_bike[cat] for cat in CATEGORIES],
+                [mode_params_ebike[cat] for cat in CATEGORIES],
+            ]
+        )
+        # alpha_m
+        self.mode_split = np.array([mode_split[mode] for mode in MODES])
+
+    @classmethod
+    def from_file(cls, path: str) -> 'Model':
+        """
+        Model with the parameters in a JSON file, an object with any of the
+        keyword arguments of ``Model``. Missing categories and modes keep the
+        values from ``params``.
+        """
+        with open(path) as f:
+            values = json.load(f)
+        defaults = {
+            'poi_gravity_values': params.poi_gravity_values,
+            'trip_generation': params.trip_generation,
+            'mode_params_bike': params.mode_params_bike,
+            'mode_params_ebike': params.mode_params_ebike,
+            'mode_split': params.mode_split,
+        }
+        unknown = set(values) - set(defaults)
+        if unknown:
+            raise ValueError(f'Unknown model parameters: {", ".join(sorted(unknown))}')
+        return cls(
+            **{
+                name: {**value, **values.get(name, {})}
+                for name, value in defaults.items()
+            }
+        )
+
+    def decay(
+        self, cats: np.ndarray, distances: np.ndarray, sizes: np.ndarray
+    ) -> np.ndarray:
+        """
+        Destination decay of each route, including the destination size.
+        """
+        # NOTE: we include dest size in decay here
+        return sizes * np.exp(self.gravity[cats] * distances / 1000.0)
+
+    def mode_probability(self, distances: np.ndarray) -> np.ndarray:
+        """
+        Probability to cycle (any mode, weighted by the mode split) at each
+        distance, of shape ``(len(CATEGORIES), len(distances))``.
+        """
+        d = np.asarray(distances, dtype=np.float64)[:, None]
+        return sum(
+            split * sigmoid(mode_params, d)
+            for split, mode_params in zip(self.mode_split, self.mode_params)
+        ).T
+
+    def cutoffs(
+        self, threshold: float, max_distance: float, step: float = 10.0
+    ) -> np.ndarray:
+        """
+        Distance per category beyond which a destination contributes less
+        than ``threshold`` times its largest contribution at any distance up
+        to ``max_distance``. The contribution of a destination is its decay
+        times the probability to cycle there.
+        """
+        if not np.isfinite(max_distance):
+            raise ValueError('Cutoffs need a finite maximum distance')
+        distances = np.append(np.arange(0.0, max_distance, step), max_distance)
+        cats = np.arange(len(CATEGORIES))[:, None]
+        relative = self.decay(cats, distances, 1.0)
+        relative *= self.mode_probability(distances)
+        relative /= relative.max(axis=1, keepdims=True)
+        # The last distance with a contribution above the threshold
+        above = relative >= threshold
+        last = len(distances) - 1 - np.argmax(above[:, ::-1], axis=1)
+        return np.minimum(distances[last] + step, max_distance)
+
+    def truncation_error(
+        self, cutoffs: np.ndarray, max_distance: float, step: float = 10.0
+    ) -> np.ndarray:
+        """
+        Relative error per category in the flow from an origin when the
+        destinations beyond ``cutoffs`` are dropped, for destinations spread
+        evenly around the origin up to ``max_distance``.
+        """
+        distances = np.arange(step / 2, max_distance, step)
+        # Decay of the destinations in a ring of the same width
+        cats = np.arange(len(CATEGORIES))[:, None]
+        decay = self.decay(cats, distances, 1.0) * distances
+        flows = decay * self.mode_probability(distances)
+        kept = distances < np.asarray(cutoffs)[:, None]
+        full = flows.sum(axis=1) / decay.sum(axis=1)
+        pruned = (flows * kept).sum(axis=1) / (decay * kept).sum(axis=1)
+        return pruned / full - 1
+
+    def evaluate(
+        self,
+        cats: np.ndarray,
+        distances: np.ndarray,
+        sizes: np.ndarray,
+        origs: np.ndarray = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Evaluate the routes from one origin, or from several when ``origs``
+        holds the origin of each route.
+
+        :param cats: category index of each route destination
+        :param distances: route distances in meters
+        :param sizes: destination sizes
+        :param origs: origin index of each route
+        :return: the decay of each route (including the destination size), the
+            decay sum per category (per origin and category, indexed by
+            ``origs * len(CATEGORIES) + cats``) and the probability of each
+            mode, of shape ``(len(MODES), routes)``
+        """
+        groups = cats if origs is None else origs * len(CATEGORIES) + cats
+        decay = self.decay(cats, distances, sizes)
+        decay_sums = np.bincount(groups, weights=decay, minlength=len(CATEGORIES))
+        p_mode = np.stack(
+            [sigmoid(mode_params[cats], distances) for mode_params in self.mode_params]
+        )
+        return decay, decay_sums, p_mode
+
+    def flows(
+        self,
+        cats: np.ndarray,
+        distances: np.ndarray,
+        sizes: np.ndarray,
+        orig_size,
+        origs: np.ndarray = None,
+        decay_sums: np.ndarray = None,
+    ) -> np.ndarray:
+        """
+        Trips per mode on each route from an origin of size ``orig_size``,
+        of shape ``(len(MODES), routes)``. For routes from several origins
+        ``origs`` and ``orig_size`` hold the origin and its size per route.
+
+        The destination choice is normalised by the decay sum of the given
+        routes, unless the sums over all routes are given in ``decay_sums``,
+        indexed as returned by ``evaluate``.
+        """
+        decay, route_decay_sums, p_mode = self.evaluate(cats, distances, sizes, origs)
+        if decay_sums is None:
+            decay_sums = route_decay_sums
+        groups = cats if origs is None else origs * len(CATEGORIES) + cats
+        share = self.trip_generation[cats] * orig_size * decay / decay_sums[groups]
+        return self.mode_split[:, None] * share * p_mode
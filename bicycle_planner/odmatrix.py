@@ -0,0 +1,111 @@
+import os
+
+from typing import List, Tuple
+
+import numpy as np
+
+from .model import CATEGORIES
+
+
+class OdMatrix:
+    """
+    Sparse matrix of the network distances between origins and destinations
+    in CSR layout, the destinations reached from origin ``i`` and their
+    distances are ``dest[orig_ptr[i] : orig_ptr[i + 1]]`` and the same slice
+    of ``distances``. Origins and destinations are indices into ``orig_ids``
+    and ``dest_ids`` (feature ids) and ``dest_cats`` (indices into
+    ``CATEGORIES``).
+    """
+
+    ARRAYS = ('orig_ptr', 'dest', 'distances', 'orig_ids', 'dest_ids', 'dest_cats')
+
+    def __init__(
+        self,
+        orig_ptr: np.ndarray,
+        dest: np.ndarray,
+        distances: np.ndarray,
+        orig_ids: np.ndarray,
+        dest_ids: np.ndarray,
+        dest_cats: np.ndarray,
+    ):
+        self.orig_ptr = orig_ptr
+        self.dest = dest
+        self.distances = distances
+        self.orig_ids = orig_ids
+        self.dest_ids = dest_ids
+        self.dest_cats = dest_cats
+
+    def __len__(self) -> int:
+        return len(self.dest)
+
+    @classmethod
+    def from_pairs(
+        cls,
+        pairs: List[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+        orig_ids: np.ndarray,
+        dest_ids: np.ndarray,
+        dest_cats: np.ndarray,
+    ) -> 'OdMatrix':
+        """
+        OD matrix from ``(orig, dest, distances)`` arrays in any order, as
+        collected by ``routing.route_origins``.
+        """
+        if pairs:
+            orig, dest, distances = (np.concatenate(arrays) for arrays in zip(*pairs))
+        else:
+            orig, dest, distances = np.zeros((3, 0))
+        order = np.argsort(orig, kind='stable')
+        orig_ptr = np.zeros(len(orig_ids) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(orig.astype(np.int64), minlength=len(orig_ids)),
+            out=orig_ptr[1:],
+        )
+        return cls(
+            orig_ptr,
+            dest[order].astype(np.int32),
+            distances[order].astype(np.float32),
+            np.asarray(orig_ids, dtype=np.int64),
+            np.asarray(dest_ids, dtype=np.int64),
+            np.asarray(dest_cats, dtype=np.int8),
+        )
+
+    def origin(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Destinations reached from origin ``i`` and their distances.
+        """
+        start, stop = self.orig_ptr[i], self.orig_ptr[i + 1]
+        return self.dest[start:stop], self.distances[start:stop]
+
+    def to_coo(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Origin feature id, destination feature id and distance of each pair.
+        """
+        orig = np.repeat(np.arange(len(self.orig_ids)), np.diff(self.orig_ptr))
+        return self.orig_ids[orig], self.dest_ids[self.dest], self.distances
+
+
+def save_od_matrix(path: str, od_matrix: OdMatrix):
+    """
+    Save the OD matrix arrays as ``.npy`` files in the directory ``path``,
+    with the category names in ``categories.npy``.
+    """
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'categories.npy'), np.array(CATEGORIES))
+    for name in OdMatrix.ARRAYS:
+        np.save(os.path.join(path, f'{name}.npy'), getattr(od_matrix, name))
+
+
+def load_od_matrix(path: str) -> OdMatrix:
+    """
+    Memory map an OD matrix saved by ``save_od_matrix``, nothing is read
+    until it is used.
+    """
+    categories = np.load(os.path.join(path, 'categories.npy'))
+    if tuple(categories) != CATEGORIES:
+        raise ValueError(f'OD matrix has other categories: {list(categories)}')
+    return OdMatrix(
+        **{
+            name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+            for name in OdMatrix.ARRAYS
+        }
+    )
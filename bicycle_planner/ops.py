@@ -1,17 +1,14 @@
+import hashlib
 import math
+import os
 
-from collections import defaultdict, namedtuple
-from time import time
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple
 
 import numpy as np
 
 from qgis.analysis import (
-    QgsNetworkDistanceStrategy,
-    QgsVectorLayerDirector,
-    QgsGraphBuilder,
     QgsGraphAnalyzer,
-    QgsNetworkStrategy,
+    QgsGraph,
 )
 from qgis.core import (
     edit,
@@ -20,9 +17,14 @@ from qgis.core import (
     QgsVectorLayer,
     QgsProcessing,
     QgsProcessingFeedback,
+    QgsProcessingMultiStepFeedback,
     QgsFeature,
+    QgsFeatureRequest,
     QgsCoordinateReferenceSystem,
-    QgsSpatialIndex,
+    QgsDistanceArea,
+    QgsExpression,
+    QgsPointXY,
+    QgsProject,
     QgsFields,
     QgsFeatureStore,
     QgsFeatureSink,
@@ -34,34 +36,375 @@ from .params import (
     MAX_DISTANCE_M,
     poi_class_map,
     poi_categories,
-    poi_gravity_values,
-    mode_params_bike,
-    mode_params_ebike,
-    trip_generation,
 )
-from .utils import timing, sigmoid
+from .cache import fingerprint, load_graph, save_graph
+from .graph import Contraction, Graph, build_graph, connected_components
+from .parallel import route_origins_parallel
+from .model import CATEGORIES, MODES, Model
+from .odmatrix import OdMatrix, save_od_matrix
+from .routes import Routes, load_network_fids, load_routes, save_routes
+from .routing import (
+    OdData,
+    reverse_categories,
+    route_destinations,
+    route_origins,
+)
+from .spatial import snap_to_segments
+from .utils import timing
+
+BACKEND_QGIS = 'qgis'
+BACKEND_NUMPY = 'numpy'
+BACKENDS = (BACKEND_QGIS, BACKEND_NUMPY)
 
 
-MAX_NEIGHBORS = 9001
+def read_segments(
+    network_layer: QgsVectorLayer, feedback: QgsProcessingFeedback = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Read the network as line segments. Reading stops early if ``feedback``
+    is canceled.
 
-Route = namedtuple('Route', 'i j cat distance decay p_bike p_ebike net_fids')
+    :return: ``x0, y0, x1, y1`` of each segment, the feature id it belongs to
+        and the index of its first vertex within the feature
+    """
+    segment_xy = []
+    segment_fid = []
+    segment_index = []
+    request = QgsFeatureRequest().setNoAttributes()
+    step = 100.0 / max(network_layer.featureCount(), 1)
+    for n, feature in enumerate(network_layer.getFeatures(request)):
+        if feedback is not None and n % 1000 == 0:
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(n * step)
+        geom = feature.geometry()
+        parts = geom.asMultiPolyline() if geom.isMultipart() else [geom.asPolyline()]
+        # Vertices are numbered across parts like QgsGeometry does
+        first = 0
+        for part in parts:
+            n = len(part)
+            if n > 1:
+                xy = np.array([(point.x(), point.y()) for point in part])
+                segment_xy.append(np.hstack((xy[:-1], xy[1:])))
+                segment_fid.append(np.full(n - 1, feature.id(), dtype=np.int64))
+                segment_index.append(np.arange(first, first + n - 1))
+            first += n
+
+    if not segment_xy:
+        return np.empty((0, 4)), np.empty(0, np.int64), np.empty(0, np.int64)
+    return (
+        np.concatenate(segment_xy),
+        np.concatenate(segment_fid),
+        np.concatenate(segment_index),
+    )
+
+
+def read_fids(layer: QgsVectorLayer) -> np.ndarray:
+    """
+    Feature ids of the layer in iteration order.
+    """
+    request = QgsFeatureRequest().setNoAttributes()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    return np.fromiter(
+        (feature.id() for feature in layer.getFeatures(request)), dtype=np.int64
+    )
 
 
-class SaveFidStrategy(QgsNetworkStrategy):
+def read_points(
+    layer: QgsVectorLayer, fields: List[str], expression: str = None
+) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
     """
-    Strategy class to save the underlying network link feature ids. The QGIS
-    graph builder does not save information about the network used to build
-    the routing graph. This class is a hack to enable mapping route_points paths back
-    onto the network by querying the cost of each edge. The edge object returns
-    the fid of the network.
+    Read a point layer into arrays in one pass, fetching only ``fields``.
+    The features can be filtered by an ``expression``, which is passed on to
+    the data provider.
+
+    :return: the feature ids, ``x, y`` of each point and the values of each
+        field as an object array, with NULL values as None
     """
+    indices = [layer.fields().lookupField(field) for field in fields]
+    for field, i in zip(fields, indices):
+        if i == -1:
+            raise Exception(f'Field {field} not found in layer {layer.name()}')
+    request = QgsFeatureRequest()
+    if expression:
+        request.setFilterExpression(expression)
+    request.setSubsetOfAttributes(indices)
+    fids = []
+    xy = []
+    columns = [[] for _ in fields]
+    for feature in layer.getFeatures(request):
+        point = feature.geometry().asPoint()
+        fids.append(feature.id())
+        xy.append((point.x(), point.y()))
+        attributes = feature.attributes()
+        for column, i in zip(columns, indices):
+            column.append(attributes[i])
+
+    values = {}
+    for field, column in zip(fields, columns):
+        # NULL is a null QVariant in older QGIS versions
+        values[field] = np.array(
+            [None if isinstance(value, QVariant) else value for value in column],
+            dtype=object,
+        )
+    return (
+        np.array(fids, dtype=np.int64),
+        np.array(xy, dtype=np.float64).reshape(-1, 2),
+        values,
+    )
+
 
-    def cost(self, distance: float, feature: QgsFeature) -> int:
-        try:
-            return int(feature.id())
-        except ValueError:
-            # TODO: log trace, make sure to do it in a thread safe way
-            return -1
+def read_origins(
+    origin_layer: QgsVectorLayer,
+    size_field: str,
+    origin_weight_field: str = None,
+    socio_data: dict = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Read the origins, their size is the size field times the weight field
+    and the socio-economic index relative to the mean of all origins.
+
+    :return: the feature ids, ``x, y`` and size of each origin
+    """
+    orig_id_field = 'deso'
+    fields = [size_field]
+    if origin_weight_field:
+        fields.append(origin_weight_field)
+    if socio_data:
+        fields.append(orig_id_field)
+    fids, xy, values = read_points(origin_layer, fields)
+    sizes = np.array(values[size_field], dtype=np.float64)
+    if origin_weight_field:
+        sizes *= np.array(values[origin_weight_field], dtype=np.float64)
+
+    if socio_data:
+        # FIXME: check if all origins have data
+        socio = np.array(
+            [socio_data[value] for value in values[orig_id_field]],
+            dtype=np.float64,
+        )
+        sizes *= socio / np.mean(socio)
+    return fids, xy, sizes
+
+
+def read_destinations(
+    poi_layer: QgsVectorLayer,
+    class_field: str,
+    work_layer: QgsVectorLayer = None,
+    work_size_field: str = None,
+    school_layer: QgsVectorLayer = None,
+    school_size_field: str = None,
+    feedback: QgsProcessingFeedback = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Read the POIs of the classes in ``poi_class_map`` and the work and
+    school destinations.
+
+    :return: the feature ids, ``x, y``, size and category index of each
+        destination, -1 for POIs without a category
+    """
+    cat_index = {cat: k for k, cat in enumerate(CATEGORIES)}
+    # Only POIs of the mapped classes, most POIs are of other classes
+    poi_filter = '{} IN ({})'.format(
+        QgsExpression.quotedColumnRef(class_field),
+        ', '.join(map(QgsExpression.quotedValue, sorted(poi_class_map))),
+    )
+    fids, xy, values = read_points(poi_layer, [class_field], poi_filter)
+    if feedback is not None:
+        feedback.pushInfo(
+            f'Read {len(fids)} of {poi_layer.featureCount()} POIs of known classes'
+        )
+    cats = [
+        cat_index.get(poi_class_map.get(value), -1) for value in values[class_field]
+    ]
+    # TODO: dest size
+    parts = [(fids, xy, np.ones(len(fids)), np.array(cats, dtype=np.int64))]
+    for layer, layer_size_field, cat in (
+        (work_layer, work_size_field, 'work'),
+        (school_layer, school_size_field, 'school'),
+    ):
+        if layer:
+            fids, xy, values = read_points(layer, [layer_size_field])
+            # TODO: dest size
+            sizes = np.array(values[layer_size_field], dtype=np.float64)
+            cats = np.full(len(fids), cat_index[cat], dtype=np.int64)
+            parts.append((fids, xy, sizes, cats))
+    return tuple(np.concatenate(arrays) for arrays in zip(*parts))
+
+
+def select(mask: np.ndarray, *arrays: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """
+    The rows of each array where ``mask`` is set.
+    """
+    return tuple(array[mask] for array in arrays)
+
+
+def qgs_graph_from_graph(net_graph: Graph) -> QgsGraph:
+    """
+    Rebuild a QGIS graph from arrays, e.g. a cached graph. The edge costs
+    match those of a graph built with ``build_graph``.
+    """
+    graph = QgsGraph()
+    for x, y in net_graph.vertex_xy.tolist():
+        graph.addVertex(QgsPointXY(x, y))
+    for edge_from, edge_to, length, fid in zip(
+        net_graph.edge_from.tolist(),
+        net_graph.edge_to.tolist(),
+        net_graph.edge_length.tolist(),
+        net_graph.edge_fid.tolist(),
+    ):
+        graph.addEdge(edge_from, edge_to, [length, fid])
+    return graph
+
+
+def qgis_shortest_paths(
+    graph: QgsGraph, net_graph: Graph, contraction: Contraction = None
+) -> Callable[[int], Tuple[np.ndarray, np.ndarray]]:
+    """
+    Shortest path function for ``routing.route_origins`` calculating the
+    trees with ``QgsGraphAnalyzer``. With a ``contraction`` the QGIS graph
+    is built from the contracted graph and the trees are expanded to trees
+    of ``net_graph``.
+    """
+
+    def shortest_paths(vertex_id):
+        # Calculate the tree and cost using the distance strategy (#0)
+        if contraction is None:
+            return QgsGraphAnalyzer.dijkstra(graph, vertex_id, 0)
+        tree, cost = QgsGraphAnalyzer.dijkstra(
+            graph, contraction.vertex_id(vertex_id), 0
+        )
+        return contraction.expand(net_graph, tree, cost)
+
+    return shortest_paths
+
+
+def ellipsoid_measure(
+    crs: QgsCoordinateReferenceSystem, feedback: QgsProcessingFeedback = None
+) -> Callable[[np.ndarray, np.ndarray], np.ndarray]:
+    """
+    Length function for ``build_graph`` measuring on the WGS84 ellipsoid, in
+    any CRS, like ``QgsGraphBuilder`` does by default. If ``feedback`` is
+    canceled the remaining edges are left unmeasured.
+    """
+    distance_area = QgsDistanceArea()
+    distance_area.setSourceCrs(crs, QgsProject.instance().transformContext())
+    distance_area.setEllipsoid('WGS84')
+
+    def measure(xy_from, xy_to):
+        lengths = np.zeros(len(xy_from))
+        step = 100.0 / max(len(xy_from), 1)
+        for n, (a, b) in enumerate(zip(xy_from.tolist(), xy_to.tolist())):
+            if feedback is not None and n % 10000 == 0:
+                if feedback.isCanceled():
+                    break
+                feedback.setProgress(n * step)
+            lengths[n] = distance_area.measureLine(QgsPointXY(*a), QgsPointXY(*b))
+        return lengths
+
+    return measure
+
+
+def make_graph(
+    network_layer: QgsVectorLayer,
+    points_xy: np.ndarray,
+    feedback: QgsProcessingFeedback = None,
+) -> Optional[Tuple[Graph, np.ndarray]]:
+    """
+    Build the routing graph of the network with the points ``points_xy``
+    tied to it. Each point is tied to the closest location on the network,
+    like the tie points of ``QgsVectorLayerDirector.makeGraph``. The network
+    fid and segment of every edge are recorded in the graph.
+
+    :return: the graph and the vertex id of each tied point, None if canceled
+    """
+    if feedback is None:
+        feedback = QgsProcessingFeedback()
+    # Reading the network and measuring the edges take most of the time
+    steps = QgsProcessingMultiStepFeedback(2, feedback)
+
+    with timing('read network segments'):
+        segment_xy, segment_fid, segment_index = read_segments(network_layer, steps)
+    if feedback.isCanceled():
+        return None
+
+    with timing('tie points to network'):
+        point_segment, point_xy = snap_to_segments(segment_xy, points_xy)
+    if feedback.isCanceled():
+        return None
+
+    steps.setCurrentStep(1)
+    with timing('build network graph'):
+        graph = build_graph(
+            segment_xy,
+            segment_fid,
+            segment_index,
+            point_segment,
+            point_xy,
+            ellipsoid_measure(network_layer.crs(), steps),
+        )
+    if feedback.isCanceled():
+        return None
+    return graph
+
+
+def layer_fingerprint(layer: QgsVectorLayer) -> tuple:
+    """
+    Values identifying the content of a layer for the graph cache. Memory
+    layers, e.g. temporary processing outputs, get a new source on every run
+    and are identified by a hash of their features instead.
+    """
+    provider = layer.providerType()
+    if provider == 'memory':
+        digest = hashlib.sha1()
+        request = QgsFeatureRequest().setNoAttributes()
+        for feature in layer.getFeatures(request):
+            digest.update(str(feature.id()).encode())
+            digest.update(bytes(feature.geometry().asWkb()))
+        source = digest.hexdigest()
+        mtime = None
+    else:
+        source = layer.source()
+        path = source.split('|')[0]
+        mtime = os.path.getmtime(path) if os.path.isfile(path) else None
+
+    return (
+        provider,
+        source,
+        mtime,
+        layer.subsetString(),
+        layer.featureCount(),
+        layer.extent().toString(),
+        layer.crs().toWkt(),
+    )
+
+
+def cached_graph(
+    network_layer: QgsVectorLayer,
+    points_xy: np.ndarray,
+    cache_dir: str = None,
+    feedback: QgsProcessingFeedback = None,
+) -> Optional[Tuple[Graph, np.ndarray]]:
+    """
+    ``make_graph``, loading the graph from ``cache_dir`` if it was built from
+    the same network and points before, and caching it there otherwise.
+    """
+    if not cache_dir:
+        return make_graph(network_layer, points_xy, feedback)
+
+    with timing('fingerprint graph inputs'):
+        cache_key = fingerprint(*layer_fingerprint(network_layer), points_xy)
+    cached = load_graph(cache_dir, cache_key)
+    if cached is not None:
+        if feedback is not None:
+            feedback.pushInfo(f'Using cached network graph {cache_key}')
+        return cached
+
+    built = make_graph(network_layer, points_xy, feedback)
+    if built is not None:
+        with timing('cache network graph'):
+            save_graph(cache_dir, cache_key, *built)
+    return built
 
 
 @timing()
@@ -81,8 +424,19 @@ def generate_od_routes(
     diversity_data=None,
     join_on: str = None,
     max_distance: int = 25000,
+    cutoff: float = MAX_DISTANCE_M,
+    network_candidates: bool = False,
+    reverse_routing: bool = True,
+    contribution_threshold: float = 0,
+    contract: bool = True,
     return_layer: bool = True,
     return_raw: bool = False,
+    backend: str = BACKEND_QGIS,
+    workers: int = 1,
+    cache_dir: str = None,
+    routes_dir: str = None,
+    od_matrix_dir: str = None,
+    model: Model = None,
     feedback: QgsProcessingFeedback = None,
 ) -> QgsVectorLayer:
     """
@@ -94,89 +448,50 @@ def generate_od_routes(
     :param origin_field: name of from field
     :param destination_field: name of to field
     :param max_distance: maximum distance/cost
+    :param cutoff: maximum route distance, routes longer than this are dropped
+        and the search is bounded by it (0 to disable, which also lifts the
+        euclidean ``max_distance``)
+    :param network_candidates: skip the euclidean pre-filter of destinations
+        within ``max_distance``, every destination in the shortest path tree
+        of an origin within ``cutoff`` is used
+    :param contribution_threshold: if given, routes of each category are cut
+        off where a destination contributes less than this fraction of its
+        largest contribution (decay times probability to cycle), and the
+        resulting error is reported
+    :param reverse_routing: route the categories with few destinations from
+        the destinations, when that takes fewer shortest path trees
+    :param contract: route on the graph with its chains of degree two
+        vertices contracted, see ``graph.Contraction``
     :param crs: output layer crs
+    :param return_raw: also return the bike and ebike flows as arrays of shape
+        ``(len(CATEGORIES), network features)`` and the ``Routes``, whose
+        ``incidence`` assigns other route weights to the network, when not
+        returning a layer
+    :param backend: shortest path implementation, one of ``BACKENDS``
+    :param workers: number of processes to route origins in, worker processes
+        always use the NumPy backend
+    :param cache_dir: directory to cache the built graph in, graphs built from
+        the same network and points are loaded from it instead of rebuilt
+    :param routes_dir: directory to save the routes in, for evaluating other
+        model parameters with ``evaluate_od_routes``
+    :param od_matrix_dir: directory to save the network distances between
+        origins and destinations in, see ``odmatrix.load_od_matrix``. Empty
+        origins and destinations, and those on network islands without any
+        counterpart, are not routed and left out
+    :param model: model parameters, defaults to those in ``params``
     """
 
     if not network_layer.wkbType() & QgsWkbTypes.LineString:
         raise Exception('Network layer must be of type LineString')
-    crs = network_layer.crs()
-
-    ## prepare graph
-    director = QgsVectorLayerDirector(
-        source=network_layer,
-        directionFieldId=-1,
-        directDirectionValue='',
-        reverseDirectionValue='',
-        bothDirectionValue='',
-        defaultDirection=QgsVectorLayerDirector.DirectionBoth,
-    )
-    # First strategy is for actual shortest distance calculation
-    director.addStrategy(QgsNetworkDistanceStrategy())  # 0
-    # Second strategy is a hack to be able to recover the edge id
-    director.addStrategy(SaveFidStrategy())  # 1
-    builder = QgsGraphBuilder(crs)
-
-    ## spatial index
-
-    poi_sidx = QgsSpatialIndex(poi_layer)
-    work_sidx = QgsSpatialIndex(work_layer)
-    school_sidx = QgsSpatialIndex(school_layer)
-
-    ## prepare points
-    orig_n = len(origin_layer)
-    poi_n = len(poi_layer)
-    work_n = len(work_layer) if work_layer else 0
-    school_n = len(school_layer) if school_layer else 0
-    dest_n = poi_n + work_n + school_n
-
-    orig_points = [None] * orig_n
-    orig_sizes = np.zeros(orig_n, dtype=float)
-    if socio_data:
-        orig_socio = np.zeros(orig_n, dtype=float)
-    dest_points = [None] * dest_n
-    dest_sizes = [None] * dest_n
-    dest_fids = [None] * dest_n
-    dest_cats = [None] * dest_n
-
-    orig_id_field = 'deso'
-    for i, feat in enumerate(origin_layer.getFeatures()):
-        orig_points[i] = feat.geometry().asPoint()
-        orig_sizes[i] = feat[size_field] * (
-            feat[origin_weight_field] if origin_weight_field else 1
-        )
-
-        if socio_data:
-            orig_socio[i] = socio_data[
-                feat[orig_id_field]
-            ]  # FIXME: check if all origins have data
-
-    if socio_data:
-        orig_socio = orig_socio / np.mean(orig_socio)
-        orig_sizes *= orig_socio
-
-    for i, feat in enumerate(poi_layer.getFeatures()):
-        dest_points[i] = feat.geometry().asPoint()
-        dest_fids[i] = feat.id()
-        dest_sizes[i] = 1  # TODO: dest size
-        dest_cats[i] = poi_class_map.get(feat[class_field])
-
-    if work_layer:
-        for i, feat in enumerate(work_layer.getFeatures(), start=poi_n):
-            dest_points[i] = feat.geometry().asPoint()
-            dest_fids[i] = feat.id()
-            dest_sizes[i] = feat[work_size_field]  # TODO: dest size
-            dest_cats[i] = 'work'
-
-    if school_layer:
-        for i, feat in enumerate(school_layer.getFeatures(), start=(poi_n + work_n)):
-            dest_points[i] = feat.geometry().asPoint()
-            dest_fids[i] = feat.id()
-            dest_sizes[i] = feat[school_size_field]  # TODO: dest size
-            dest_cats[i] = 'school'
-
-    # points = [origin.point for origin in origins_data] + [
-    #    dest.point for dest in dests_data
-    # ]
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown routing backend: {backend}')
+    if cutoff > 0:
+        # The euclidean distance is a lower bound of the network distance
+        max_distance = min(max_distance, cutoff)
+    else:
+        cutoff = max_distance = math.inf
+    if network_candidates:
+        max_distance = math.inf
 
     if feedback is None:
         feedback = QgsProcessingFeedback()
@@ -187,199 +502,278 @@ def generate_od_routes(
 
         feedback.progressChanged.connect(progress)
 
-    with timing('build network graph'):
-        tied_points = director.makeGraph(
-            builder, orig_points + dest_points, feedback=feedback
+    ## prepare points
+    with timing('read origins'):
+        orig_fids, orig_xy, orig_sizes = read_origins(
+            origin_layer, size_field, origin_weight_field, socio_data
+        )
+    with timing('read destinations'):
+        dest_fids, dest_xy, dest_sizes, dest_cats = read_destinations(
+            poi_layer,
+            class_field,
+            work_layer,
+            work_size_field,
+            school_layer,
+            school_size_field,
+            feedback,
         )
-        graph = builder.graph()
-
-    orig_tied_points = tied_points[:orig_n]
-    dest_tied_points = tied_points[orig_n:]
-
-    poi_tied_points = dest_tied_points[:poi_n]
-    work_tied_points = dest_tied_points[poi_n : poi_n + work_n]
-    school_tied_points = dest_tied_points[poi_n + work_n :]
-
-    dest_fid_to_tied_points = dict(zip(dest_fids, enumerate(dest_tied_points)))
 
-    poi_fid_to_tied_points = dict(zip(dest_fids[:poi_n], enumerate(poi_tied_points)))
-    work_fid_to_tied_points = dict(
-        zip(dest_fids[poi_n : poi_n + work_n], enumerate(work_tied_points, start=poi_n))
+    # Origins without a size and destinations without a size or category
+    # never carry flow, drop them before snapping and routing
+    orig_keep = orig_sizes > 0
+    dest_keep = (dest_sizes > 0) & (dest_cats >= 0)
+    if not np.all(orig_keep):
+        feedback.pushInfo(f'Skipping {np.sum(~orig_keep)} empty origins')
+    if not np.all(dest_keep):
+        feedback.pushInfo(
+            f'Skipping {np.sum(~dest_keep)} destinations without size or category'
+        )
+    orig_fids, orig_xy, orig_sizes = select(orig_keep, orig_fids, orig_xy, orig_sizes)
+    dest_fids, dest_xy, dest_sizes, dest_cats = select(
+        dest_keep, dest_fids, dest_xy, dest_sizes, dest_cats
     )
-    school_fid_to_tied_points = dict(
-        zip(
-            dest_fids[poi_n + work_n :],
-            enumerate(school_tied_points, start=poi_n + work_n),
+    orig_n = len(orig_fids)
+
+    points_xy = np.concatenate((orig_xy, dest_xy))
+    built = cached_graph(network_layer, points_xy, cache_dir, feedback)
+    if built is None:
+        return
+    net_graph, vertex_ids = built
+
+    orig_vertex_ids = vertex_ids[:orig_n]
+    dest_vertex_ids = vertex_ids[orig_n:]
+
+    # Points on network islands without any destination, or any origin, can
+    # never be part of a route, drop them before routing
+    with timing('label network components'):
+        components = connected_components(net_graph)
+    orig_keep = np.isin(components[orig_vertex_ids], components[dest_vertex_ids])
+    dest_keep = np.isin(components[dest_vertex_ids], components[orig_vertex_ids])
+    if not np.all(orig_keep):
+        feedback.pushInfo(
+            f'Skipping {np.sum(~orig_keep)} origins without reachable destinations'
+        )
+    if not np.all(dest_keep):
+        feedback.pushInfo(
+            f'Skipping {np.sum(~dest_keep)} destinations without reachable origins'
         )
+    orig_fids, orig_xy, orig_sizes, orig_vertex_ids = select(
+        orig_keep, orig_fids, orig_xy, orig_sizes, orig_vertex_ids
     )
+    dest_fids, dest_xy, dest_sizes, dest_cats, dest_vertex_ids = select(
+        dest_keep, dest_fids, dest_xy, dest_sizes, dest_cats, dest_vertex_ids
+    )
+    orig_n = len(orig_fids)
 
-    orig_dests = [None] * orig_n
-    for i, point in enumerate(orig_points):
-        orig_dests[i] = (
-            [
-                poi_fid_to_tied_points[fid]
-                for fid in poi_sidx.nearestNeighbor(
-                    point, neighbors=MAX_NEIGHBORS, maxDistance=max_distance
-                )
-            ]
-            + [
-                work_fid_to_tied_points[fid]
-                for fid in work_sidx.nearestNeighbor(
-                    point, neighbors=MAX_NEIGHBORS, maxDistance=max_distance
-                )
-            ]
-            + [
-                school_fid_to_tied_points[fid]
-                for fid in school_sidx.nearestNeighbor(
-                    point, neighbors=MAX_NEIGHBORS, maxDistance=max_distance
-                )
-            ]
+    contraction = None
+    if contract:
+        with timing('contract network graph'):
+            contraction = Contraction.from_graph(
+                net_graph, np.concatenate((orig_vertex_ids, dest_vertex_ids))
+            )
+        feedback.pushInfo(
+            f'Contracted graph to {contraction.graph.vertex_count} of '
+            f'{net_graph.vertex_count} vertices'
         )
 
-    step = 100.0 / orig_n
-    time_dijkstra = 0.0
-    time_find = 0.0
-    time_route = 0.0
-    with timing('calculate connecting routes'):
-        routes = []
-        # for i, (origin_fid, dest_fids) in enumerate(od_data):
-        for i, (orig_point, dests) in enumerate(zip(orig_tied_points, orig_dests)):
-            origin_vertex_id = graph.findVertex(orig_point)
+    graph = None
+    if backend == BACKEND_QGIS and workers <= 1:
+        with timing('create qgis graph'):
+            graph = qgs_graph_from_graph(
+                net_graph if contraction is None else contraction.graph
+            )
 
-            # Calculate the tree and cost using the distance strategy (#0)
-            ts = time()
-            (tree, cost) = QgsGraphAnalyzer.dijkstra(graph, origin_vertex_id, 0)
-            time_dijkstra += time() - ts
+    od = OdData(
+        orig_xy=orig_xy,
+        orig_vertex_ids=orig_vertex_ids,
+        orig_sizes=orig_sizes,
+        dest_xy=dest_xy,
+        dest_vertex_ids=dest_vertex_ids,
+        dest_sizes=dest_sizes,
+        dest_cats=dest_cats,
+    )
 
-            for j, dest_point in dests:
-                if feedback.isCanceled():
-                    return
-                if dest_sizes[j] <= 0:
-                    continue
-                category = dest_cats[j]
-                if category is None:
-                    continue
-                ts = time()
-                dest_vertex_id = graph.findVertex(dest_point)
-                time_find += time() - ts
-                if tree[dest_vertex_id] != -1 and (
-                    cost[dest_vertex_id] <= MAX_DISTANCE_M
-                    or MAX_DISTANCE_M <= 0  # TODO: enable skipping max distance
-                ):
-                    route_distance = cost[dest_vertex_id]
-                    # route_points = [graph.vertex(dest_vertex_id).point()]
-                    cur_vertex_id = dest_vertex_id
-                    route_fids = []
-                    # Iterate the graph from dest to origin saving the edges
-                    ts = time()
-                    while cur_vertex_id != origin_vertex_id:
-                        cur_edge = graph.edge(tree[cur_vertex_id])
-                        # Here we recover the edge id through strategy #1
-                        route_fids.append(cur_edge.cost(1))
-                        cur_vertex_id = cur_edge.fromVertex()
-                        # route_points.append(graph.vertex(cur_vertex_id).point())
-                    time_route += time() - ts
-
-                    # route_points.reverse()
-                    # route_geom = QgsGeometry.fromPolylineXY(route_points))
-
-                    # Hack to remove duplicate fids
-                    route_fids = list(
-                        dict.fromkeys(route_fids)
-                    )  # NOTE: requires python >= 3.7 for ordered dict FIXME: add python version check
-                    route_fids.reverse()
-
-                    # Calc
-                    # TODO: Move to matrix and vectorize calculation using numpy
-                    gravity_value = poi_gravity_values[category]
-                    bike_params = mode_params_bike[category]
-                    ebike_params = mode_params_ebike[category]
-
-                    # NOTE: we include dest size in decay here
-                    decay = dest_sizes[j] * math.exp(
-                        gravity_value * route_distance / 1000.0
-                    )
-                    p_bike = sigmoid(*bike_params, route_distance)
-                    p_ebike = sigmoid(*ebike_params, route_distance)
-
-                    # TODO: use namedtuple or dataclass
-                    routes.append(
-                        Route(
-                            i,
-                            j,
-                            category,
-                            route_distance,
-                            decay,
-                            p_bike,
-                            p_ebike,
-                            route_fids,
-                        )
-                    )
-            feedback.setProgress(i * step)
-
-        print(f'dijkstra took: {time_dijkstra:#1.2f} sec')
-        print(f'find vertex took: {time_find:#1.2f} sec')
-        print(f'route took: {time_route:#1.2f} sec')
-
-    with timing('post process routes'):
-        alpha_bike = 0.8
-        alpha_ebke = 0.2
-
-        decay_sums = {cat: defaultdict(float) for cat in poi_categories}
-        bike_values = {cat: defaultdict(float) for cat in poi_categories}
-        ebike_values = {cat: defaultdict(float) for cat in poi_categories}
-
-        for route in routes:
-            # NOTE: dest size is included in decay
-            decay_sums[route.cat][route.i] += route.decay
-        for route in routes:
-            decay_sum = decay_sums[route.cat][route.i]
-            # TODO: add T_p and alpha_m
-            T_p = trip_generation[route.cat]
-            bike_value = (
-                T_p
-                * alpha_bike
-                * orig_sizes[route.i]
-                * route.p_bike
-                * route.decay
-                / decay_sum
+    with timing('index network rows'):
+        # Flows are accumulated per network feature in iteration order
+        network_fids = read_fids(network_layer)
+        row_n = len(network_fids)
+        sorter = np.argsort(network_fids)
+        edge_row = sorter[
+            np.searchsorted(network_fids, net_graph.edge_fid, sorter=sorter)
+        ]
+
+    record = bool(routes_dir) or (return_raw and not return_layer)
+    routes = [] if record else None
+    od_pairs = [] if od_matrix_dir else None
+    if contribution_threshold > 0:
+        if model is None:
+            model = Model()
+        # The sigmoid is scaled to MAX_DISTANCE_M
+        limit = cutoff if math.isfinite(cutoff) else MAX_DISTANCE_M
+        cutoff = model.cutoffs(contribution_threshold, limit)
+        errors = model.truncation_error(cutoff, limit)
+        for cat, cat_cutoff, error in zip(CATEGORIES, cutoff, errors):
+            feedback.pushInfo(
+                f'{cat}: routes up to {cat_cutoff:.0f} m, '
+                f'estimated flow error {100 * error:+.1f}%'
             )
-            ebike_value = (
-                T_p
-                * alpha_ebke
-                * orig_sizes[route.i]
-                * route.p_ebike
-                * route.decay
-                / decay_sum
+        # An infinite max_distance selects the destinations by route distance
+        if math.isfinite(max_distance):
+            max_distance = min(max_distance, cutoff.max())
+
+    # Categories with few destinations are routed from the destinations
+    reverse = np.zeros(len(CATEGORIES), dtype=bool)
+    if reverse_routing:
+        reverse = reverse_categories(od)
+    reversed_dests = np.isin(od.dest_cats, np.flatnonzero(reverse))
+    origin_od = od._replace(dest_sizes=np.where(reversed_dests, 0.0, od.dest_sizes))
+    dest_od = od._replace(dest_sizes=np.where(reversed_dests, od.dest_sizes, 0.0))
+    forward = np.any((origin_od.dest_sizes > 0) & (od.dest_cats >= 0))
+    if np.any(reverse):
+        reversed_cats = ', '.join(np.compress(reverse, CATEGORIES))
+        feedback.pushInfo(f'Routing from destinations: {reversed_cats}')
+
+    shortest_paths = None
+    if graph is not None:
+        shortest_paths = qgis_shortest_paths(graph, net_graph, contraction)
+
+    flows = np.zeros((len(MODES), len(CATEGORIES), row_n))
+    with timing('calculate connecting routes'):
+        if forward:
+            if workers > 1:
+                origin_flows = route_origins_parallel(
+                    net_graph,
+                    origin_od,
+                    edge_row,
+                    row_n,
+                    max_distance,
+                    cutoff,
+                    contraction=contraction,
+                    model=model,
+                    routes=routes,
+                    od_pairs=od_pairs,
+                    workers=workers,
+                    feedback=feedback,
+                )
+            else:
+                origin_flows = route_origins(
+                    net_graph,
+                    origin_od,
+                    range(orig_n),
+                    edge_row,
+                    row_n,
+                    max_distance,
+                    cutoff,
+                    shortest_paths,
+                    contraction=contraction,
+                    model=model,
+                    routes=routes,
+                    od_pairs=od_pairs,
+                    feedback=feedback,
+                )
+            if origin_flows is None:
+                return
+            flows += origin_flows
+
+        if np.any(reverse):
+            dest_flows = route_destinations(
+                net_graph,
+                dest_od,
+                edge_row,
+                row_n,
+                max_distance,
+                cutoff,
+                shortest_paths,
+                contraction=contraction,
+                model=model,
+                routes=routes,
+                od_pairs=od_pairs,
+                feedback=feedback,
+            )
+            if dest_flows is None:
+                return
+            flows += dest_flows
+
+    if record:
+        routes = Routes.concatenate(routes, row_n)
+    if routes_dir:
+        with timing('save routes'):
+            save_routes(routes_dir, routes, network_fids)
+    if od_matrix_dir:
+        with timing('save od matrix'):
+            save_od_matrix(
+                od_matrix_dir,
+                OdMatrix.from_pairs(od_pairs, orig_fids, dest_fids, od.dest_cats),
             )
-            for fid in route.net_fids:
-                bike_values[route.cat][fid] += float(bike_value)
-                ebike_values[route.cat][fid] += float(ebike_value)
+
+    return flow_output(network_layer, flows, return_layer, return_raw, routes)
+
+
+@timing()
+def evaluate_od_routes(
+    network_layer: QgsVectorLayer,
+    routes_dir: str,
+    model: Model = None,
+    return_layer: bool = True,
+    return_raw: bool = False,
+) -> QgsVectorLayer:
+    """
+    Flows on the network for new model parameters, from the routes saved by
+    ``generate_od_routes`` without building the graph or routing again.
+
+    :param network_layer: the road network the routes were generated on, its
+        features are matched to the routes by fid
+    :param routes_dir: directory the routes were saved in
+    :param model: model parameters, defaults to those in ``params``
+    :param return_raw: as for ``generate_od_routes``
+    """
+    routes = load_routes(routes_dir)
+    route_fids = load_network_fids(routes_dir)
+    network_fids = read_fids(network_layer)
+    if route_fids is None or not np.array_equal(
+        np.sort(route_fids), np.sort(network_fids)
+    ):
+        raise Exception('Routes were generated on a different network layer')
+    # The features may be read in another order than when routing
+    routes = routes.reorder(route_fids, network_fids)
+
+    with timing('evaluate routes'):
+        flows = routes.evaluate(model)
+
+    return flow_output(network_layer, flows, return_layer, return_raw, routes)
+
+
+def flow_output(
+    network_layer: QgsVectorLayer,
+    flows: np.ndarray,
+    return_layer: bool = True,
+    return_raw: bool = False,
+    routes: Routes = None,
+):
+    """
+    Network features with the flows per mode, category and network row, as
+    a layer or a list of features (and the raw flows and routes).
+    """
+    # Bike and ebike flows of shape (categories, network rows)
+    bike_values, ebike_values = flows
+    total_flows = flows.sum(axis=(0, 1))
 
     # FIXME: Un-kludge this
     with timing('create result features'):
         fields = get_fields()
 
         segments = []
-        for feature in network_layer.getFeatures():
+        for row, feature in enumerate(network_layer.getFeatures()):
             fid = feature.id()
             segment = QgsFeature(fields)
             segment.setGeometry(QgsGeometry(feature.geometry()))
 
             segment['network_fid'] = fid
-            flow = 0.0
-            for cat in poi_categories:
-                bike_field = f'{cat}_bike_value'
-                ebike_field = f'{cat}_ebike_value'
-
-                flow_bike = segment[bike_field] = bike_values[cat].get(fid)
-                flow_ebke = segment[ebike_field] = ebike_values[cat].get(fid)
-
-                if flow_bike is not None:
-                    flow += flow_bike
-                if flow_ebke is not None:
-                    flow += flow_ebke
+            for k, cat in enumerate(CATEGORIES):
+                segment[f'{cat}_bike_value'] = float(bike_values[k, row])
+                segment[f'{cat}_ebike_value'] = float(ebike_values[k, row])
 
+            flow = float(total_flows[row])
             segment['flow'] = flow
             segment['lts'] = feature['lts']
             segment['vgu'] = feature['vgu']
@@ -388,12 +782,12 @@ def generate_od_routes(
 
     if not return_layer:
         if return_raw:
-            return segments, bike_values, ebike_values
+            return segments, bike_values, ebike_values, routes
         return segments
 
     with timing('create result layer'):
         output_layer = QgsVectorLayer(
-            f'LineString?crs={crs.toWkt()}', 'segments', 'memory'
+            f'LineString?crs={network_layer.crs().toWkt()}', 'segments', 'memory'
         )
         with edit(output_layer):
             for field in fields:
@@ -0,0 +1,238 @@
+import math
+import multiprocessing
+import os
+import sys
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .graph import Contraction, Graph
+from .model import CATEGORIES, MODES, Model
+from .routes import Routes
+from .routing import OdData, route_origins
+
+
+class SharedArrays:
+    """
+    Copies of NumPy arrays in shared memory. Other processes attach to them
+    through ``spec`` without the arrays being pickled.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.blocks = []
+        self.spec = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            # Zero sized blocks are not allowed
+            block = SharedMemory(create=True, size=max(array.nbytes, 1))
+            self.blocks.append(block)
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            shared[...] = array
+            self.spec[name] = (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def attach(spec: dict) -> Tuple[Dict[str, np.ndarray], list]:
+    """
+    Attach to arrays shared by ``SharedArrays``. The returned blocks must be
+    kept alive as long as the arrays are used.
+    """
+    arrays = {}
+    blocks = []
+    for name, (block_name, shape, dtype) in spec.items():
+        try:
+            # Python >= 3.13, the creating process owns the block
+            block = SharedMemory(name=block_name, track=False)
+        except TypeError:
+            block = SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    return arrays, blocks
+
+
+def python_executable() -> str:
+    """
+    Python interpreter to start workers with. Inside QGIS ``sys.executable``
+    is the QGIS binary, which must not be spawned for every worker.
+    """
+    executable = sys.executable
+    if os.path.basename(executable).lower().startswith('python'):
+        return executable
+    for folder in (sys.exec_prefix, os.path.join(sys.exec_prefix, 'bin')):
+        for name in ('python.exe', 'python3', 'python'):
+            path = os.path.join(folder, name)
+            if os.path.isfile(path):
+                return path
+    return executable
+
+
+# Worker state, set up once per process by _init_worker
+_worker = {}
+
+
+def _init_worker(
+    graph_spec: dict,
+    od_spec: dict,
+    row_n: int,
+    max_distance: float,
+    cutoff: float,
+    model: Model,
+    contraction_spec: dict = None,
+):
+    graph_arrays, graph_blocks = attach(graph_spec)
+    od_arrays, od_blocks = attach(od_spec)
+    contraction = None
+    contraction_blocks = []
+    if contraction_spec is not None:
+        contraction_arrays, contraction_blocks = attach(contraction_spec)
+        contraction = Contraction.from_arrays(contraction_arrays)
+    _worker['graph'] = Graph.from_arrays(graph_arrays)
+    _worker['edge_row'] = graph_arrays['edge_row']
+    _worker['row_n'] = row_n
+    _worker['od'] = OdData(**od_arrays)
+    _worker['max_distance'] = max_distance
+    _worker['cutoff'] = cutoff
+    _worker['model'] = model
+    _worker['contraction'] = contraction
+    _worker['blocks'] = graph_blocks + od_blocks + contraction_blocks
+
+
+def _route_chunk(
+    origins: np.ndarray, record_routes: bool, record_od_pairs: bool
+) -> tuple:
+    routes = [] if record_routes else None
+    od_pairs = [] if record_od_pairs else None
+    flows = route_origins(
+        _worker['graph'],
+        _worker['od'],
+        origins,
+        _worker['edge_row'],
+        _worker['row_n'],
+        _worker['max_distance'],
+        _worker['cutoff'],
+        contraction=_worker['contraction'],
+        model=_worker['model'],
+        routes=routes,
+        od_pairs=od_pairs,
+    )
+    if record_routes:
+        routes = Routes.concatenate(routes, _worker['row_n'])
+    if record_od_pairs and od_pairs:
+        od_pairs = tuple(np.concatenate(arrays) for arrays in zip(*od_pairs))
+    # Only return the rows carrying flow to keep the result small
+    rows = np.flatnonzero(np.any(flows != 0, axis=(0, 1)))
+    return rows, flows[:, :, rows], routes, od_pairs
+
+
+def route_origins_parallel(
+    graph: Graph,
+    od: OdData,
+    edge_row: np.ndarray,
+    row_n: int,
+    max_distance: float = math.inf,
+    cutoff: float = math.inf,
+    contraction: Contraction = None,
+    model: Model = None,
+    routes: List[Routes] = None,
+    od_pairs: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+    workers: int = None,
+    chunk_size: int = None,
+    feedback=None,
+) -> Optional[np.ndarray]:
+    """
+    Parallel version of ``routing.route_origins`` over all origins. Origins
+    are split in chunks that are routed by a pool of worker processes, which
+    attach to a shared memory copy of the graph and origin/destination arrays.
+    The partial network flows of the chunks are summed.
+
+    :param contraction: contraction of ``graph`` to calculate the shortest
+        path trees on, shared with the workers like the graph
+    :param model: model parameters, defaults to those in ``params``
+    :param routes: if given, the routes of each chunk are appended to it
+    :param od_pairs: if given, the origin, destination and distance arrays of
+        each chunk are appended to it
+    :param workers: number of worker processes, defaults to the CPU count
+    :param chunk_size: origins per task, by default each worker gets about
+        ten chunks to balance the load and report progress. Origins tied to
+        the same vertex are kept in one chunk
+    :param feedback: optional ``QgsProcessingFeedback`` for progress and
+        cancellation
+    :return: flows per mode, category and network row as in
+        ``routing.route_origins``, None if canceled
+    """
+    workers = workers or os.cpu_count() or 1
+    orig_n = len(od.orig_vertex_ids)
+    if chunk_size is None:
+        chunk_size = max(1, math.ceil(orig_n / (10 * workers)))
+    # Origins sorted by vertex and chunks split between vertices, so that
+    # origins sharing a tree are routed together
+    order = np.argsort(od.orig_vertex_ids, kind='stable')
+    group_starts = np.flatnonzero(np.diff(od.orig_vertex_ids[order])) + 1
+    # The first group starting at or after each multiple of chunk_size
+    k = np.searchsorted(group_starts, np.arange(chunk_size, orig_n, chunk_size))
+    bounds = np.unique(np.append(group_starts, orig_n)[k])
+    chunks = [chunk for chunk in np.split(order, bounds[bounds < orig_n]) if len(chunk)]
+
+    context = multiprocessing.get_context('spawn')
+    context.set_executable(python_executable())
+
+    flows = np.zeros((len(MODES), len(CATEGORIES), row_n))
+    graph_arrays = graph.to_arrays()
+    graph_arrays['edge_row'] = edge_row
+    contraction_arrays = {} if contraction is None else contraction.to_arrays()
+    with SharedArrays(graph_arrays) as graph_shared, SharedArrays(
+        od._asdict()
+    ) as od_shared, SharedArrays(contraction_arrays) as contraction_shared:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(
+                graph_shared.spec,
+                od_shared.spec,
+                row_n,
+                max_distance,
+                cutoff,
+                model,
+                None if contraction is None else contraction_shared.spec,
+            ),
+        )
+        try:
+            record = (routes is not None, od_pairs is not None)
+            pending = {
+                executor.submit(_route_chunk, chunk, *record) for chunk in chunks
+            }
+            done_n = 0
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                if feedback is not None and feedback.isCanceled():
+                    return None
+                for future in done:
+                    rows, chunk_flows, chunk_routes, chunk_pairs = future.result()
+                    flows[:, :, rows] += chunk_flows
+                    if routes is not None:
+                        routes.append(chunk_routes)
+                    if chunk_pairs:
+                        od_pairs.append(chunk_pairs)
+                    done_n += 1
+                if feedback is not None:
+                    feedback.setProgress(100.0 * done_n / len(chunks))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    return flows
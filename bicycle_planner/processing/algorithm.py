@@ -17,11 +17,17 @@ from qgis.core import (
     QgsProcessingParameterVectorDestination,
     QgsVectorLayer,
     QgsProcessingParameterFile,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterFolderDestination,
+    QgsProcessingParameterBoolean,
 )
 from PyQt5.QtCore import QVariant
 
 
-from ..ops import get_fields, generate_od_routes
+from ..model import Model
+from ..ops import get_fields, generate_od_routes, evaluate_od_routes, BACKENDS
+from ..params import MAX_DISTANCE_M
 from ..utils import make_single, make_centroids
 
 
@@ -58,6 +64,18 @@ class FlowAlgorithm(QgsProcessingAlgorithm):
     SCHOOL_N_FIELD = 'SCHOOL_N_FIELD'
     CLASS_FIELD = 'CLASS_FIELD'
 
+    BACKEND = 'BACKEND'
+    MAX_DISTANCE = 'MAX_DISTANCE'
+    NETWORK_CANDIDATES = 'NETWORK_CANDIDATES'
+    REVERSE_ROUTING = 'REVERSE_ROUTING'
+    CONTRIBUTION_THRESHOLD = 'CONTRIBUTION_THRESHOLD'
+    CONTRACT_GRAPH = 'CONTRACT_GRAPH'
+    WORKERS = 'WORKERS'
+    CACHE_DIR = 'CACHE_DIR'
+    MODEL_FILE = 'MODEL_FILE'
+    ROUTES_DIR = 'ROUTES_DIR'
+    OD_MATRIX_DIR = 'OD_MATRIX_DIR'
+
     OUTPUT = 'OUTPUT'
 
     def initAlgorithm(self, config):
@@ -170,6 +188,109 @@ class FlowAlgorithm(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.BACKEND,
+                self.tr('Routing backend'),
+                options=[self.tr('QGIS graph analyzer'), self.tr('NumPy CSR graph')],
+                defaultValue=0,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MAX_DISTANCE,
+                self.tr('Maximum route distance (m, 0 for no limit)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                defaultValue=MAX_DISTANCE_M,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.NETWORK_CANDIDATES,
+                self.tr('Select destinations by route distance only'),
+                defaultValue=False,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.REVERSE_ROUTING,
+                self.tr('Route from destinations when they are fewer than origins'),
+                defaultValue=True,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CONTRIBUTION_THRESHOLD,
+                self.tr(
+                    'Drop destinations contributing less than this fraction '
+                    '(per category, 0 to keep all)'
+                ),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                maxValue=1,
+                defaultValue=0,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.CONTRACT_GRAPH,
+                self.tr('Route on the network with chains of segments contracted'),
+                defaultValue=True,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                self.tr('Number of worker processes (uses the NumPy backend if > 1)'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                defaultValue=1,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.CACHE_DIR,
+                self.tr('Network graph cache directory (empty for no cache)'),
+                behavior=QgsProcessingParameterFile.Folder,
+                optional=True,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.MODEL_FILE,
+                self.tr('Model parameters (JSON)'),
+                optional=True,
+                extension='json',
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFolderDestination(
+                self.ROUTES_DIR,
+                self.tr('Routes for evaluating other model parameters'),
+                optional=True,
+                createByDefault=False,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFolderDestination(
+                self.OD_MATRIX_DIR,
+                self.tr('Origin-destination distance matrix'),
+                optional=True,
+                createByDefault=False,
+            )
+        )
+
         # We add a feature sink in which to store our processed features (this
         # usually takes the form of a newly created vector layer when the
         # algorithm is run in QGIS).
@@ -200,6 +321,25 @@ class FlowAlgorithm(QgsProcessingAlgorithm):
         school_n_field = self.parameterAsString(
             parameters, self.SCHOOL_N_FIELD, context
         )
+        backend = BACKENDS[self.parameterAsEnum(parameters, self.BACKEND, context)]
+        cutoff = self.parameterAsDouble(parameters, self.MAX_DISTANCE, context)
+        network_candidates = self.parameterAsBool(
+            parameters, self.NETWORK_CANDIDATES, context
+        )
+        reverse_routing = self.parameterAsBool(
+            parameters, self.REVERSE_ROUTING, context
+        )
+        contribution_threshold = self.parameterAsDouble(
+            parameters, self.CONTRIBUTION_THRESHOLD, context
+        )
+        contract = self.parameterAsBool(parameters, self.CONTRACT_GRAPH, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        cache_dir = self.parameterAsFile(parameters, self.CACHE_DIR, context)
+        model_file = self.parameterAsFile(parameters, self.MODEL_FILE, context)
+        routes_dir = self.parameterAsFileOutput(parameters, self.ROUTES_DIR, context)
+        od_matrix_dir = self.parameterAsFileOutput(
+            parameters, self.OD_MATRIX_DIR, context
+        )
 
         network_layer = make_single(
             network_source,
@@ -258,6 +398,17 @@ class FlowAlgorithm(QgsProcessingAlgorithm):
             size_field=pop_field,
             class_field=class_field,
             return_layer=False,
+            cutoff=cutoff,
+            network_candidates=network_candidates,
+            reverse_routing=reverse_routing,
+            contribution_threshold=contribution_threshold,
+            contract=contract,
+            backend=backend,
+            workers=workers,
+            cache_dir=cache_dir or None,
+            routes_dir=routes_dir or None,
+            od_matrix_dir=od_matrix_dir or None,
+            model=Model.from_file(model_file) if model_file else None,
             feedback=feedback,
         )
 
@@ -280,7 +431,12 @@ class FlowAlgorithm(QgsProcessingAlgorithm):
                 break
             feedback.setProgress(i * step)
 
-        return {self.OUTPUT: sink_id}
+        results = {self.OUTPUT: sink_id}
+        if routes_dir:
+            results[self.ROUTES_DIR] = routes_dir
+        if od_matrix_dir:
+            results[self.OD_MATRIX_DIR] = od_matrix_dir
+        return results
 
     def name(self):
         """
@@ -323,6 +479,103 @@ class FlowAlgorithm(QgsProcessingAlgorithm):
         return FlowAlgorithm()
 
 
+class EvaluateFlowAlgorithm(QgsProcessingAlgorithm):
+    """
+    Flows on the network for new model parameters, from the routes saved by
+    the flow algorithm, without routing again.
+    """
+
+    NETWORK = 'NETWORK'
+    ROUTES_DIR = 'ROUTES_DIR'
+    MODEL_FILE = 'MODEL_FILE'
+    OUTPUT = 'OUTPUT'
+
+    def initAlgorithm(self, config):
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.NETWORK,
+                self.tr('Network layer the routes were generated on'),
+                [QgsProcessing.TypeVectorLine],
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.ROUTES_DIR,
+                self.tr('Routes directory'),
+                behavior=QgsProcessingParameterFile.Folder,
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.MODEL_FILE,
+                self.tr('Model parameters (JSON)'),
+                optional=True,
+                extension='json',
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Output layer'))
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        network_source = self.parameterAsVectorLayer(parameters, self.NETWORK, context)
+        routes_dir = self.parameterAsFile(parameters, self.ROUTES_DIR, context)
+        model_file = self.parameterAsFile(parameters, self.MODEL_FILE, context)
+
+        network_layer = make_single(
+            network_source,
+            context=context,
+            feedback=feedback,
+            is_child_algorithm=True,
+        )
+
+        features = evaluate_od_routes(
+            network_layer=network_layer,
+            routes_dir=routes_dir,
+            model=Model.from_file(model_file) if model_file else None,
+            return_layer=False,
+        )
+
+        (sink, sink_id) = self.parameterAsSink(
+            parameters,
+            self.OUTPUT,
+            context,
+            get_fields(),
+            network_layer.wkbType(),
+            network_layer.sourceCrs(),
+        )
+
+        step = 100.0 / max(len(features), 1)
+        for i, feature in enumerate(features):
+            if feedback.isCanceled():
+                break
+            sink.addFeature(feature, QgsFeatureSink.FastInsert)
+            feedback.setProgress(i * step)
+
+        return {self.OUTPUT: sink_id}
+
+    def name(self):
+        return 'evaluateflows'
+
+    def displayName(self):
+        return self.tr('Evaluate bicycle flows for new model parameters')
+
+    def group(self):
+        return self.tr('Vector processing')
+
+    def groupId(self):
+        return 'vector'
+
+    def tr(self, string):
+        return string  # QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return EvaluateFlowAlgorithm()
+
+
 class NvdbAlgorithm(QgsProcessingAlgorithm):
     """
     This is an example algorithm that takes a vector layer and
@@ -3,7 +3,7 @@ import os.path
 from qgis.core import QgsProcessingProvider
 from qgis.PyQt.QtGui import QIcon
 
-from .algorithm import FlowAlgorithm, NvdbAlgorithm
+from .algorithm import EvaluateFlowAlgorithm, FlowAlgorithm, NvdbAlgorithm
 from ..assets import icon
 
 
@@ -27,6 +27,7 @@ class Provider(QgsProcessingProvider):
         """
         print('provider loadAlgo')
         self.addAlgorithm(FlowAlgorithm())
+        self.addAlgorithm(EvaluateFlowAlgorithm())
         self.addAlgorithm(NvdbAlgorithm())
         # add additional algorithms here
         # self.addAlgorithm(MyOtherAlgorithm())
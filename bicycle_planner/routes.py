@@ -0,0 +1,201 @@
+import os
+
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from .model import CATEGORIES, MODES, Model
+
+
+class Incidence:
+    """
+    Sparse routes x network rows incidence matrix ``A`` in CSR layout, the
+    rows passed by route ``r`` are ``indices[indptr[r] : indptr[r + 1]]``.
+    This is the layout of ``scipy.sparse.csr_matrix`` with all data one.
+    """
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, shape: Tuple[int, int]):
+        self.indptr = indptr
+        self.indices = indices
+        self.shape = shape
+
+    @property
+    def nnz(self) -> int:
+        return len(self.indices)
+
+    def assign(
+        self, weights: np.ndarray, columns: np.ndarray = None, column_n: int = None
+    ) -> np.ndarray:
+        """
+        Assign route weights to the network rows, i.e. the product ``A.T @ w``.
+
+        :param weights: weight of each route, or one row of route weights per
+            weighting to assign several (modes, scenarios) at once
+        :param columns: output column of each route, e.g. its category. The
+            result then has a row per column, as the product with a weight
+            matrix holding the weight of each route in its column only
+        :param column_n: number of output columns
+        :return: flows of shape ``weights.shape[:-1] + (column_n, row_n)``,
+            without ``column_n`` if no columns are given
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        route_n, row_n = self.shape
+        counts = np.diff(self.indptr)
+        bins = np.asarray(self.indices, dtype=np.int64)
+        shape = (row_n,)
+        if columns is not None:
+            bins = np.repeat(columns, counts) * row_n + bins
+            shape = (column_n, row_n)
+
+        flows = [
+            np.bincount(
+                bins,
+                weights=np.repeat(route_weights, counts),
+                minlength=int(np.prod(shape)),
+            )
+            for route_weights in weights.reshape(-1, route_n)
+        ]
+        return np.reshape(flows, weights.shape[:-1] + shape)
+
+
+class Routes:
+    """
+    The routes of a run, with everything needed to evaluate the model again
+    without routing: the origin, destination vertex, category, sizes and
+    network distance of each route, and the network rows passed by each route as
+    ``rows[row_ptr[r] : row_ptr[r + 1]]``.
+    """
+
+    ARRAYS = (
+        'orig',
+        'dest_vertices',
+        'cats',
+        'distances',
+        'orig_sizes',
+        'dest_sizes',
+        'row_ptr',
+        'rows',
+    )
+
+    def __init__(
+        self,
+        row_n: int,
+        orig: np.ndarray,
+        dest_vertices: np.ndarray,
+        cats: np.ndarray,
+        distances: np.ndarray,
+        orig_sizes: np.ndarray,
+        dest_sizes: np.ndarray,
+        row_ptr: np.ndarray,
+        rows: np.ndarray,
+    ):
+        self.row_n = row_n
+        self.orig = orig
+        self.dest_vertices = dest_vertices
+        self.cats = cats
+        self.distances = distances
+        self.orig_sizes = orig_sizes
+        self.dest_sizes = dest_sizes
+        self.row_ptr = row_ptr
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.orig)
+
+    @property
+    def incidence(self) -> Incidence:
+        return Incidence(self.row_ptr, self.rows, (len(self), self.row_n))
+
+    @classmethod
+    def concatenate(cls, parts: List['Routes'], row_n: int) -> 'Routes':
+        if not parts:
+            index = np.zeros(0, dtype=np.int64)
+            value = np.zeros(0)
+            return cls(
+                row_n,
+                index,
+                index,
+                index,
+                value,
+                value,
+                value,
+                np.zeros(1, dtype=np.int64),
+                np.zeros(0, dtype=np.int32),
+            )
+        arrays = {
+            name: np.concatenate([getattr(part, name) for part in parts])
+            for name in cls.ARRAYS
+            if name != 'row_ptr'
+        }
+        counts = np.concatenate([np.diff(part.row_ptr) for part in parts])
+        row_ptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=row_ptr[1:])
+        return cls(row_n, row_ptr=row_ptr, **arrays)
+
+    def reorder(self, row_fids: np.ndarray, new_row_fids: np.ndarray) -> 'Routes':
+        """
+        The routes with their rows renumbered from the network features
+        ``row_fids`` to the positions of the same features in ``new_row_fids``,
+        e.g. when the features are read in another order.
+        """
+        new_row_fids = np.asarray(new_row_fids)
+        sorter = np.argsort(new_row_fids)
+        new_rows = sorter[np.searchsorted(new_row_fids, row_fids, sorter=sorter)]
+        arrays = {name: getattr(self, name) for name in self.ARRAYS}
+        arrays['rows'] = new_rows[self.rows].astype(np.int32)
+        return Routes(len(new_row_fids), **arrays)
+
+    def evaluate(self, model: Model = None) -> np.ndarray:
+        """
+        Flows per mode, category and network row for the parameters of
+        ``model`` (defaults to those in ``params``), as returned by
+        ``routing.route_origins``.
+        """
+        if model is None:
+            model = Model()
+
+        if not len(self):
+            return np.zeros((len(MODES), len(CATEGORIES), self.row_n))
+
+        route_flows = model.flows(
+            self.cats, self.distances, self.dest_sizes, self.orig_sizes, self.orig
+        )
+        return self.incidence.assign(route_flows, self.cats, len(CATEGORIES))
+
+
+def save_routes(path: str, routes: Routes, network_fids: np.ndarray = None):
+    """
+    Save the route arrays as ``.npy`` files in the directory ``path``.
+
+    :param network_fids: network feature id of each row, see
+        ``load_network_fids``
+    """
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'row_n.npy'), np.array(routes.row_n))
+    for name in Routes.ARRAYS:
+        np.save(os.path.join(path, f'{name}.npy'), getattr(routes, name))
+    if network_fids is not None:
+        np.save(os.path.join(path, 'network_fids.npy'), np.asarray(network_fids))
+
+
+def load_routes(path: str) -> Routes:
+    """
+    Memory map routes saved by ``save_routes``.
+    """
+    row_n = int(np.load(os.path.join(path, 'row_n.npy')))
+    arrays = {
+        name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+        for name in Routes.ARRAYS
+    }
+    return Routes(row_n, **arrays)
+
+
+def load_network_fids(path: str) -> Optional[np.ndarray]:
+    """
+    Network feature id of each row of the routes saved in ``path``, None if
+    they were saved without them.
+    """
+    filename = os.path.join(path, 'network_fids.npy')
+    if not os.path.isfile(filename):
+        return None
+    return np.load(filename)
@@ -0,0 +1,509 @@
+import math
+
+from collections import namedtuple
+from time import time
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .graph import Contraction, Graph, dijkstra, tree_flows, tree_paths
+from .model import CATEGORIES, MODES, Model
+from .routes import Routes
+from .spatial import GridIndex
+
+
+# Origins and destinations as arrays, dest_cats holds indices into CATEGORIES
+# (-1 for destinations without a category).
+OdData = namedtuple(
+    'OdData',
+    'orig_xy orig_vertex_ids orig_sizes dest_xy dest_vertex_ids dest_sizes dest_cats',
+)
+
+
+def candidates(
+    od: OdData, origins: List[int], max_distance: float, batch_size: int = 1 << 20
+) -> Iterator[np.ndarray]:
+    """
+    Destinations within ``max_distance`` (euclidean) of each origin. The
+    destinations are bucketed in a grid and the origins are queried in
+    batches with at most ``batch_size`` destinations in the grid cells they
+    check, or one origin if it has more. This bounds the memory used by a
+    query, however dense the destinations are.
+
+    Without a ``max_distance`` every destination with a size and category is
+    a candidate, they are then only filtered by their network distance.
+    """
+    if math.isinf(max_distance):
+        dests = np.flatnonzero((od.dest_sizes > 0) & (od.dest_cats >= 0))
+        for _ in origins:
+            yield dests
+        return
+
+    index = GridIndex(od.dest_xy, max(max_distance, 1.0))
+    ends = np.cumsum(index.candidate_counts(od.orig_xy[origins], max_distance))
+    start = 0
+    while start < len(origins):
+        done = ends[start - 1] if start else 0
+        stop = int(np.searchsorted(ends, done + batch_size, side='right'))
+        batch = origins[start : max(stop, start + 1)]
+        ptr, dests = index.query(od.orig_xy[batch], max_distance)
+        for k in range(len(batch)):
+            yield dests[ptr[k] : ptr[k + 1]]
+        start += len(batch)
+
+
+def aggregate_destinations(
+    od: OdData, dests: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Vertices, categories and sizes of the destinations ``dests`` with a size
+    and category. Destinations tied to the same vertex and of the same
+    category are combined, with their sizes summed. Their routes are the
+    same and the model is linear in the destination size, so the flows do
+    not change.
+    """
+    cat_n = len(CATEGORIES)
+    dests = dests[(od.dest_sizes[dests] > 0) & (od.dest_cats[dests] >= 0)]
+    (keys, inverse) = np.unique(
+        od.dest_vertex_ids[dests] * cat_n + od.dest_cats[dests], return_inverse=True
+    )
+    sizes = np.bincount(inverse, weights=od.dest_sizes[dests], minlength=len(keys))
+    return keys // cat_n, keys % cat_n, sizes
+
+
+def origin_routes(
+    graph: Graph,
+    tree: np.ndarray,
+    vertices: np.ndarray,
+    edge_row: np.ndarray,
+    row_n: int,
+    **arrays,
+) -> Routes:
+    """
+    Routes from the root of ``tree`` to ``vertices`` with the network rows
+    they pass, ``arrays`` are the other ``Routes`` arrays.
+    """
+    paths, edges = tree_paths(graph, tree, vertices)
+    # Each route passes a network row once, also when split in several edges
+    keys = np.unique(paths * row_n + edge_row[edges])
+    row_ptr = np.zeros(len(vertices) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // row_n, minlength=len(vertices)), out=row_ptr[1:])
+    rows = (keys % row_n).astype(np.int32)
+    return Routes(row_n, row_ptr=row_ptr, rows=rows, **arrays)
+
+
+def default_shortest_paths(
+    graph: Graph, cutoff: float, contraction: Contraction = None
+) -> Callable[[int], Tuple[np.ndarray, np.ndarray]]:
+    """
+    Shortest path trees of ``graph`` bounded by ``cutoff``, calculated on
+    ``contraction`` if given.
+    """
+
+    def shortest_paths(vertex_id):
+        if contraction is not None:
+            return contraction.dijkstra(graph, vertex_id, cutoff)
+        return dijkstra(graph, vertex_id, cutoff)
+
+    return shortest_paths
+
+
+def add_tree_flows(
+    flows: np.ndarray,
+    graph: Graph,
+    tree: np.ndarray,
+    vertices: np.ndarray,
+    cats: np.ndarray,
+    route_flows: np.ndarray,
+    edge_row: np.ndarray,
+):
+    """
+    Add the flows of the routes from the root of ``tree`` to ``vertices`` to
+    ``flows``, per mode, category and network row.
+
+    All routes share the same tree, so the flows are placed on their end
+    vertices and pushed towards the root in one pass instead of walking each
+    route, with one column per mode and category.
+
+    :param route_flows: flows of shape ``(len(MODES), len(vertices))``
+    """
+    cat_n = len(CATEGORIES)
+    weights = np.zeros((len(vertices), len(MODES) * cat_n))
+    route_ids = np.arange(len(vertices))
+    for m in range(len(MODES)):
+        weights[route_ids, m * cat_n + cats] = route_flows[m]
+
+    edges, edge_flows = tree_flows(graph, tree, vertices, weights)
+    np.add.at(
+        flows,
+        (slice(None), slice(None), edge_row[edges]),
+        edge_flows.T.reshape(len(MODES), cat_n, -1),
+    )
+
+
+def print_times(time_dijkstra: float, time_flow: float):
+    """
+    Print the time spent calculating the trees and assigning the flows.
+    """
+    print(f'dijkstra took: {time_dijkstra:#1.2f} sec')
+    print(f'flow took: {time_flow:#1.2f} sec')
+
+
+def route_origins(
+    graph: Graph,
+    od: OdData,
+    origins: Iterable[int],
+    edge_row: np.ndarray,
+    row_n: int,
+    max_distance: float = math.inf,
+    cutoff: float = math.inf,
+    shortest_paths: Callable[[int], Tuple[list, list]] = None,
+    contraction: Contraction = None,
+    model: Model = None,
+    routes: List[Routes] = None,
+    od_pairs: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+    feedback=None,
+) -> Optional[np.ndarray]:
+    """
+    Calculate the shortest path tree of each origin and accumulate the bike and
+    ebike flows to its candidate destinations on the network.
+
+    Origins are handled one at a time, the candidate destinations are found
+    and the flows of an origin are added to the network as soon as its tree
+    is calculated. Memory use is bounded by the destinations of one origin.
+    Origins tied to the same vertex are routed with one tree.
+
+    :param edge_row: network row (feature) of each graph edge
+    :param row_n: number of network rows
+    :param max_distance: euclidean radius of the candidate destinations, if
+        infinite the destinations are only filtered by the route distance,
+        looked up for all of them at once in the cost of the tree
+    :param cutoff: maximum route distance, or one per category, the trees
+        are bounded by the largest
+    :param shortest_paths: function returning ``(tree, cost)`` for an origin
+        vertex, defaults to the NumPy ``dijkstra``
+    :param contraction: contraction of ``graph`` to calculate the default
+        shortest path trees on, the tied vertices must be protected
+    :param model: model parameters, defaults to those in ``params``
+    :param routes: if given, the routes of each origin are appended to it
+        for evaluating other model parameters later. Without a
+        ``max_distance`` origins sharing a vertex have their routes combined
+    :param od_pairs: if given, the origin, destination and network distance
+        arrays of the routes of each origin are appended to it
+    :param feedback: optional ``QgsProcessingFeedback`` for progress and
+        cancellation
+    :return: flows of shape ``(len(MODES), len(CATEGORIES), row_n)``, None if
+        canceled
+    """
+    cat_n = len(CATEGORIES)
+    cutoffs = np.broadcast_to(np.asarray(cutoff, dtype=np.float64), (cat_n,))
+    cutoff = cutoffs.max()
+
+    if shortest_paths is None:
+        shortest_paths = default_shortest_paths(graph, cutoff, contraction)
+
+    if model is None:
+        model = Model()
+
+    flows = np.zeros((len(MODES), cat_n, row_n))
+
+    # Without a max_distance all destinations are candidates of every origin
+    all_dests = None
+    if math.isinf(max_distance):
+        all_dests = aggregate_destinations(od, np.arange(len(od.dest_vertex_ids)))
+
+    # Origins tied to the same vertex share one shortest path tree
+    origins = np.fromiter(origins, dtype=np.int64)
+    origins = origins[np.argsort(od.orig_vertex_ids[origins], kind='stable')]
+    groups = np.split(origins, np.flatnonzero(np.diff(od.orig_vertex_ids[origins])) + 1)
+    origin_dests = candidates(od, origins, max_distance)
+
+    step = 100.0 / max(len(origins), 1)
+    done_n = 0
+    time_dijkstra = 0.0
+    time_flow = 0.0
+    for group in groups:
+        if not len(group):
+            continue
+        if feedback is not None and feedback.isCanceled():
+            return None
+
+        origin_vertex_id = int(od.orig_vertex_ids[group[0]])
+
+        ts = time()
+        (tree, cost) = shortest_paths(origin_vertex_id)
+        tree = np.asarray(tree)
+        cost = np.asarray(cost)
+        time_dijkstra += time() - ts
+
+        ts = time()
+        group_dests = [next(origin_dests) for _ in group]
+        if od_pairs is not None:
+            for i, dests in zip(group, group_dests):
+                vertices = od.dest_vertex_ids[dests]
+                reached = (
+                    (od.dest_sizes[dests] > 0)
+                    & (od.dest_cats[dests] >= 0)
+                    & (tree[vertices] != -1)
+                    & (cost[vertices] <= cutoffs[od.dest_cats[dests]])
+                )
+                od_pairs.append(
+                    (
+                        np.full(np.count_nonzero(reached), i),
+                        dests[reached],
+                        cost[vertices[reached]],
+                    )
+                )
+
+        if all_dests is None:
+            units = [
+                (i, od.orig_sizes[i], aggregate_destinations(od, dests))
+                for i, dests in zip(group, group_dests)
+            ]
+        else:
+            # The origins have the same routes and their flows scale with the
+            # origin size, so the group is handled as one origin
+            units = [(group[0], od.orig_sizes[group].sum(), all_dests)]
+
+        for i, orig_size, (vertices, cats, sizes) in units:
+            reachable = (tree[vertices] != -1) & (cost[vertices] <= cutoffs[cats])
+            if not np.any(reachable):
+                continue
+            vertices = vertices[reachable]
+            cats = cats[reachable]
+            sizes = sizes[reachable]
+            route_flows = model.flows(cats, cost[vertices], sizes, orig_size)
+
+            add_tree_flows(flows, graph, tree, vertices, cats, route_flows, edge_row)
+
+            if routes is not None:
+                routes.append(
+                    origin_routes(
+                        graph,
+                        tree,
+                        vertices,
+                        edge_row,
+                        row_n,
+                        orig=np.full(len(vertices), i),
+                        dest_vertices=vertices,
+                        cats=cats,
+                        distances=cost[vertices],
+                        orig_sizes=np.full(len(vertices), orig_size),
+                        dest_sizes=sizes,
+                    )
+                )
+        time_flow += time() - ts
+
+        done_n += len(group)
+        if feedback is not None:
+            feedback.setProgress(done_n * step)
+
+    print_times(time_dijkstra, time_flow)
+
+    return flows
+
+
+def reverse_categories(od: OdData) -> np.ndarray:
+    """
+    Categories to route from the destinations with ``route_destinations``,
+    as a mask indexed like ``CATEGORIES``.
+
+    Routing from the destinations takes two trees per destination vertex,
+    routing from the origins one tree per origin vertex, shared by all
+    categories. The categories with few enough destination vertices are
+    reversed, if that saves trees overall.
+    """
+    cat_n = len(CATEGORIES)
+    orig_vertex_n = len(np.unique(od.orig_vertex_ids[od.orig_sizes > 0]))
+    valid = (od.dest_sizes > 0) & (od.dest_cats >= 0)
+    dest_vertex_ids = [
+        np.unique(od.dest_vertex_ids[valid & (od.dest_cats == k)]) for k in range(cat_n)
+    ]
+    present = np.array([len(vertex_ids) > 0 for vertex_ids in dest_vertex_ids])
+    reverse = np.array(
+        [2 * len(vertex_ids) < orig_vertex_n for vertex_ids in dest_vertex_ids]
+    )
+    reverse &= present
+
+    if not np.any(reverse):
+        return reverse
+    reverse_trees = 2 * len(
+        np.unique(np.concatenate([dest_vertex_ids[k] for k in np.flatnonzero(reverse)]))
+    )
+    forward_trees = orig_vertex_n if np.any(present & ~reverse) else 0
+    if reverse_trees + forward_trees >= orig_vertex_n:
+        reverse[:] = False
+    return reverse
+
+
+def route_destinations(
+    graph: Graph,
+    od: OdData,
+    edge_row: np.ndarray,
+    row_n: int,
+    max_distance: float = math.inf,
+    cutoff: float = math.inf,
+    shortest_paths: Callable[[int], Tuple[list, list]] = None,
+    contraction: Contraction = None,
+    model: Model = None,
+    routes: List[Routes] = None,
+    od_pairs: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+    feedback=None,
+) -> Optional[np.ndarray]:
+    """
+    The flows of ``route_origins`` for all origins, calculated with one
+    shortest path tree per destination vertex instead of per origin vertex.
+    The routes are found from the destinations to the origins, so the graph
+    must have the same edges in both directions.
+
+    The destination choice of an origin is normalised over its destinations
+    in all trees. The trees are therefore calculated twice: the first pass
+    sums the decay of the destinations per origin and category, the second
+    assigns the flows.
+
+    Parameters and result as for ``route_origins``.
+    """
+    cat_n = len(CATEGORIES)
+    cutoffs = np.broadcast_to(np.asarray(cutoff, dtype=np.float64), (cat_n,))
+    cutoff = cutoffs.max()
+
+    if shortest_paths is None:
+        shortest_paths = default_shortest_paths(graph, cutoff, contraction)
+
+    if model is None:
+        model = Model()
+
+    orig_n = len(od.orig_vertex_ids)
+    flows = np.zeros((len(MODES), cat_n, row_n))
+
+    origins = np.arange(orig_n)
+    origin_index = None
+    if not math.isinf(max_distance):
+        origin_index = GridIndex(od.orig_xy[origins], max(max_distance, 1.0))
+
+    dests = np.flatnonzero((od.dest_sizes > 0) & (od.dest_cats >= 0))
+    dests = dests[np.argsort(od.dest_vertex_ids[dests], kind='stable')]
+    groups = np.split(dests, np.flatnonzero(np.diff(od.dest_vertex_ids[dests])) + 1)
+    groups = [group for group in groups if len(group)]
+
+    def group_routes(group, tree, cost, record):
+        """
+        Origin, category, destination size and distance of the routes to
+        the destinations in ``group``, combined per origin and category.
+        """
+        if origin_index is None:
+            orig_vertices = od.orig_vertex_ids[origins]
+            reached = origins[
+                (tree[orig_vertices] != -1) & (cost[orig_vertices] <= cutoff)
+            ]
+            cats, inverse = np.unique(od.dest_cats[group], return_inverse=True)
+            sizes = np.bincount(inverse, weights=od.dest_sizes[group])
+            origs = np.repeat(reached, len(cats))
+            cats = np.tile(cats, len(reached))
+            sizes = np.tile(sizes, len(reached))
+            within = cost[od.orig_vertex_ids[origs]] <= cutoffs[cats]
+            origs = origs[within]
+            cats = cats[within]
+            sizes = sizes[within]
+            if record:
+                pair_origs = np.tile(reached, len(group))
+                pair_dests = np.repeat(group, len(reached))
+                within = (
+                    cost[od.orig_vertex_ids[pair_origs]]
+                    <= cutoffs[od.dest_cats[pair_dests]]
+                )
+                pair_origs = pair_origs[within]
+                pair_dests = pair_dests[within]
+        else:
+            ptr, found = origin_index.query(od.dest_xy[group], max_distance)
+            pair_origs = origins[found]
+            pair_dests = np.repeat(group, np.diff(ptr))
+            orig_vertices = od.orig_vertex_ids[pair_origs]
+            reached = (tree[orig_vertices] != -1) & (
+                cost[orig_vertices] <= cutoffs[od.dest_cats[pair_dests]]
+            )
+            pair_origs = pair_origs[reached]
+            pair_dests = pair_dests[reached]
+            (keys, inverse) = np.unique(
+                pair_origs * cat_n + od.dest_cats[pair_dests], return_inverse=True
+            )
+            origs = keys // cat_n
+            cats = keys % cat_n
+            sizes = np.bincount(
+                inverse, weights=od.dest_sizes[pair_dests], minlength=len(keys)
+            )
+
+        if record:
+            od_pairs.append(
+                (pair_origs, pair_dests, cost[od.orig_vertex_ids[pair_origs]])
+            )
+        return origs, cats, sizes, cost[od.orig_vertex_ids[origs]]
+
+    step = 50.0 / max(len(groups), 1)
+    time_dijkstra = 0.0
+    time_flow = 0.0
+    decay_sums = np.zeros(orig_n * cat_n)
+    for assign in (False, True):
+        for n, group in enumerate(groups):
+            if feedback is not None and feedback.isCanceled():
+                return None
+
+            dest_vertex_id = int(od.dest_vertex_ids[group[0]])
+
+            ts = time()
+            (tree, cost) = shortest_paths(dest_vertex_id)
+            tree = np.asarray(tree)
+            cost = np.asarray(cost)
+            time_dijkstra += time() - ts
+
+            ts = time()
+            (origs, cats, sizes, distances) = group_routes(
+                group, tree, cost, assign and od_pairs is not None
+            )
+            if not assign:
+                decay_sums += np.bincount(
+                    origs * cat_n + cats,
+                    weights=model.decay(cats, distances, sizes),
+                    minlength=orig_n * cat_n,
+                )
+            elif len(origs):
+                route_flows = model.flows(
+                    cats,
+                    distances,
+                    sizes,
+                    od.orig_sizes[origs],
+                    origs,
+                    decay_sums=decay_sums,
+                )
+
+                # The flows are placed on the origin vertices and pushed
+                # towards the destination
+                vertices = od.orig_vertex_ids[origs]
+                add_tree_flows(
+                    flows, graph, tree, vertices, cats, route_flows, edge_row
+                )
+
+                if routes is not None:
+                    routes.append(
+                        origin_routes(
+                            graph,
+                            tree,
+                            vertices,
+                            edge_row,
+                            row_n,
+                            orig=origs,
+                            dest_vertices=np.full(len(origs), dest_vertex_id),
+                            cats=cats,
+                            distances=distances,
+                            orig_sizes=od.orig_sizes[origs],
+                            dest_sizes=sizes,
+                        )
+                    )
+            time_flow += time() - ts
+
+            if feedback is not None:
+                feedback.setProgress((assign * len(groups) + n) * step)
+
+    print_times(time_dijkstra, time_flow)
+
+    return flows
@@ -0,0 +1,214 @@
+from typing import Tuple
+
+import numpy as np
+
+
+def expand_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    Concatenation of ``arange(start, start + count)`` for each start and
+    count, without a Python loop.
+    """
+    ends = np.cumsum(counts)
+    offsets = np.repeat(starts - ends + counts, counts)
+    return offsets + np.arange(ends[-1] if len(ends) else 0)
+
+
+class GridIndex:
+    """
+    Points bucketed in a regular grid of square cells for radius queries.
+    The points are sorted by cell, so the points of a cell are one slice of
+    ``order``. With the cell size equal to the query radius only the 3 x 3
+    cells around a query point need to be checked.
+    """
+
+    def __init__(self, xy: np.ndarray, cell_size: float):
+        self.xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        self.cell_size = float(cell_size)
+        self.origin = self.xy.min(axis=0) if len(self.xy) else np.zeros(2)
+
+        cells = self.cells(self.xy)
+        self.order = np.argsort(cells, kind='stable')
+        (self.keys, self.starts, self.counts) = np.unique(
+            cells[self.order], return_index=True, return_counts=True
+        )
+
+    def cells(self, xy: np.ndarray) -> np.ndarray:
+        """
+        Cell key of each point, unique for cells within 2^31 of the origin.
+        """
+        cell = np.floor((xy - self.origin) / self.cell_size).astype(np.int64)
+        return (cell[:, 0] << 32) + cell[:, 1]
+
+    def neighbours(
+        self, cells: np.ndarray, radius: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Occupied cells within ``radius`` of each cell key in ``cells``.
+
+        :return: the index into ``cells`` and into ``keys`` of each pair
+        """
+        reach = int(np.ceil(radius / self.cell_size))
+        steps = np.arange(-reach, reach + 1)
+        offsets = (steps[:, None] << 32) + steps[None, :]
+
+        queries = np.repeat(np.arange(len(cells)), offsets.size)
+        cells = (cells[:, None] + offsets.ravel()).ravel()
+        k = np.searchsorted(self.keys, cells)
+        k[k == len(self.keys)] = 0
+        found = np.flatnonzero(self.keys[k] == cells) if len(self.keys) else k[:0]
+        return queries[found], k[found]
+
+    def candidate_counts(self, xy: np.ndarray, radius: float) -> np.ndarray:
+        """
+        Number of points in the cells ``query`` checks for each point in
+        ``xy``, an upper bound of the points it finds. Computed per distinct
+        cell without visiting the points.
+        """
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        cells, inverse = np.unique(self.cells(xy), return_inverse=True)
+        queries, k = self.neighbours(cells, radius)
+        counts = np.bincount(queries, weights=self.counts[k], minlength=len(cells))
+        return counts.astype(np.int64)[inverse.ravel()]
+
+    def query(self, xy: np.ndarray, radius: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Points within ``radius`` of each point in ``xy``, all at once. There
+        is no limit on the number of points found, ``candidate_counts`` bounds
+        the points checked.
+
+        :return: the found points of query point ``i`` as
+            ``indices[ptr[i] : ptr[i + 1]]``, in ascending order
+        """
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        queries, k = self.neighbours(self.cells(xy), radius)
+
+        # Points of the candidate cells, filtered by distance
+        queries = np.repeat(queries, self.counts[k])
+        points = self.order[expand_ranges(self.starts[k], self.counts[k])]
+        delta = self.xy[points] - xy[queries]
+        within = np.einsum('ij,ij->i', delta, delta) <= radius ** 2
+        queries = queries[within]
+        points = points[within]
+
+        order = np.lexsort((points, queries))
+        ptr = np.zeros(len(xy) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(queries, minlength=len(xy)), out=ptr[1:])
+        return ptr, points[order]
+
+
+def project_to_segments(
+    segment_xy: np.ndarray, xy: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Closest location on segment ``x0, y0, x1, y1`` in row ``i`` of
+    ``segment_xy`` to point ``i`` of ``xy``.
+
+    :return: the closest locations and their squared distances
+    """
+    start = segment_xy[:, :2]
+    direction = segment_xy[:, 2:] - start
+    length2 = np.einsum('ij,ij->i', direction, direction)
+    t = np.einsum('ij,ij->i', xy - start, direction)
+    t = np.divide(t, length2, out=np.zeros_like(t), where=length2 > 0)
+    closest = start + np.clip(t, 0.0, 1.0)[:, None] * direction
+    delta = xy - closest
+    return closest, np.einsum('ij,ij->i', delta, delta)
+
+
+def snap_to_segments(
+    segment_xy: np.ndarray,
+    xy: np.ndarray,
+    cell_size: float = None,
+    batch_size: int = 1 << 22,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Snap points to their nearest line segment, all at once.
+
+    The segments are bucketed in a grid, in every cell their bounding box
+    covers. Each point searches the cells within a growing number of cells
+    of its own, doubled until the nearest segment found is closer than any
+    segment in the cells not searched yet. Of segments at the same distance
+    the first is used.
+
+    :param segment_xy: one ``x0, y0, x1, y1`` row per segment
+    :param cell_size: grid cell size, by default most segments fit in one
+    :param batch_size: bound on the point and cell pairs searched at once
+    :return: the segment row and snapped location of each point
+    """
+    segment_xy = np.asarray(segment_xy, dtype=np.float64).reshape(-1, 4)
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    if not len(segment_xy):
+        raise ValueError('No segments to snap to')
+
+    low = np.minimum(segment_xy[:, :2], segment_xy[:, 2:])
+    high = np.maximum(segment_xy[:, :2], segment_xy[:, 2:])
+    if cell_size is None:
+        cell_size = np.percentile((high - low).max(axis=1), 90)
+    if not cell_size > 0:
+        cell_size = 1.0
+    origin = low.min(axis=0)
+
+    # Cells covered by each segment, row by row of its bounding box
+    first = np.floor((low - origin) / cell_size).astype(np.int64)
+    last = np.floor((high - origin) / cell_size).astype(np.int64)
+    size = last - first + 1
+    counts = size[:, 0] * size[:, 1]
+    index = expand_ranges(np.zeros_like(counts), counts)
+    ny = np.repeat(size[:, 1], counts)
+    cx = np.repeat(first[:, 0], counts) + index // ny
+    cy = np.repeat(first[:, 1], counts) + index % ny
+    cells = (cx << 32) + cy
+    order = np.argsort(cells, kind='stable')
+    segments = np.repeat(np.arange(len(segment_xy)), counts)[order]
+    (keys, starts, key_counts) = np.unique(
+        cells[order], return_index=True, return_counts=True
+    )
+
+    point_cell = np.floor((xy - origin) / cell_size).astype(np.int64)
+    # Searching this far from a point covers all cells
+    span = np.maximum(
+        np.abs(point_cell - first.min(axis=0)), np.abs(point_cell - last.max(axis=0))
+    ).max(axis=1)
+    point_keys = (point_cell[:, 0] << 32) + point_cell[:, 1]
+
+    point_segment = np.full(len(xy), -1, dtype=np.int64)
+    point_xy = np.empty_like(xy)
+    point_d2 = np.full(len(xy), np.inf)
+    remaining = np.arange(len(xy))
+    reach = 1
+    while len(remaining):
+        steps = np.arange(-reach, reach + 1)
+        offsets = ((steps[:, None] << 32) + steps[None, :]).ravel()
+        step = max(1, batch_size // offsets.size)
+        for start in range(0, len(remaining), step):
+            batch = remaining[start : start + step]
+            queries = np.repeat(batch, offsets.size)
+            query_cells = (point_keys[batch, None] + offsets).ravel()
+            k = np.searchsorted(keys, query_cells)
+            k[k == len(keys)] = 0
+            found = keys[k] == query_cells
+            queries = np.repeat(queries[found], key_counts[k[found]])
+            candidates = segments[expand_ranges(starts[k[found]], key_counts[k[found]])]
+
+            closest, d2 = project_to_segments(segment_xy[candidates], xy[queries])
+            # The nearest candidate of each point, the first of equals
+            order = np.lexsort((candidates, d2, queries))
+            queries, first_index = np.unique(queries[order], return_index=True)
+            nearest = order[first_index]
+            better = (d2[nearest] < point_d2[queries]) | (
+                (d2[nearest] == point_d2[queries])
+                & (candidates[nearest] < point_segment[queries])
+            )
+            queries = queries[better]
+            nearest = nearest[better]
+            point_segment[queries] = candidates[nearest]
+            point_xy[queries] = closest[nearest]
+            point_d2[queries] = d2[nearest]
+
+        done = (point_d2[remaining] <= (reach * cell_size) ** 2) | (
+            span[remaining] <= reach
+        )
+        remaining = remaining[~done]
+        reach *= 2
+
+    return point_segment, point_xy
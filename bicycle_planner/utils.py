@@ -1,5 +1,3 @@
-import math
-
 from contextlib import ContextDecorator
 from time import time
 from typing import Optional
@@ -8,8 +6,6 @@ from typing import Optional
 from qgis import processing
 from qgis.core import QgsVectorLayer, QgsProcessing, QgsWkbTypes
 
-from .params import MAX_DISTANCE_M
-
 
 def clone_layer(input_layer) -> QgsVectorLayer:
     input_layer.selectAll()
@@ -90,19 +86,6 @@ def make_deso_centroids(input_url: str) -> QgsVectorLayer:
     )
 
 
-# P_m(d)
-def sigmoid(b0, b1, b2, b3, d):
-    """
-    Sigmoid fuction for mode choice
-    """
-    d = float(d) / MAX_DISTANCE_M  # TODO: Check that this is the correct scaling
-    try:
-        S = 1 / (1 + math.exp(-(b0 + b1 * d + b2 * d ** 2 + b3 * math.sqrt(d))))
-    except OverflowError:
-        S = 'inf'
-    return S
-
-
 class timing(ContextDecorator):
     def __init__(self, msg: Optional[str] = None):
         self.msg = msg or 'execution'
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+
+from bicycle_planner.cache import fingerprint, load_graph, save_graph
+from bicycle_planner.graph import Graph
+
+from .test_graph import make_graph
+
+
+def test_round_trip(tmp_path):
+    graph = make_graph()
+    tied = np.array([2, 0])
+    save_graph(str(tmp_path), 'key', graph, tied)
+
+    cached, cached_tied = load_graph(str(tmp_path), 'key')
+    assert isinstance(cached_tied, np.memmap)
+    assert cached_tied.tolist() == [2, 0]
+    for name, array in graph.to_arrays().items():
+        cached_array = cached.to_arrays()[name]
+        assert isinstance(cached_array, np.memmap)
+        assert np.array_equal(cached_array, array)
+
+
+def test_fingerprint():
+    xy = np.array([[0.0, 0.0], [1.0, 2.0]])
+    key = fingerprint('network', 10, xy)
+    assert fingerprint('network', 10, xy.copy()) == key
+    assert fingerprint('network', 10, xy + 1.0) != key
+    assert fingerprint('network', 10, xy.astype(np.float32)) != key
+    assert fingerprint('network', 11, xy) != key
+    assert fingerprint('other', 10, xy) != key
+
+
+def test_missing(tmp_path):
+    assert load_graph(str(tmp_path), 'key') is None
+
+    # A directory without all graph arrays, e.g. from an older version
+    save_graph(str(tmp_path), 'key', make_graph(), np.array([0]))
+    os.remove(os.path.join(str(tmp_path), 'key', f'{Graph.ARRAYS[0]}.npy'))
+    assert load_graph(str(tmp_path), 'key') is None
+
+
+def test_save_twice(tmp_path):
+    graph = make_graph()
+    save_graph(str(tmp_path), 'key', graph, np.array([0]))
+    # Another run caching the same graph
+    save_graph(str(tmp_path), 'key', graph, np.array([0]))
+    cached, tied = load_graph(str(tmp_path), 'key')
+    assert np.array_equal(cached.edge_to, graph.edge_to)
+    assert os.listdir(str(tmp_path)) == ['key']
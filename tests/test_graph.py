@@ -0,0 +1,147 @@
+import math
+
+import numpy as np
+
+from bicycle_planner.graph import (
+    Contraction,
+    Graph,
+    build_graph,
+    connected_components,
+    dijkstra,
+    tree_depth,
+    tree_flows,
+    tree_paths,
+)
+
+
+def graph_from_lines(lines, vertex_count):
+    """
+    Graph with an edge in both directions for each ``(a, b, length, fid)`` line.
+    """
+    edge_from, edge_to, edge_length, edge_fid = [], [], [], []
+    for a, b, length, fid in lines:
+        for u, v in ((a, b), (b, a)):
+            edge_from.append(u)
+            edge_to.append(v)
+            edge_length.append(length)
+            edge_fid.append(fid)
+    return Graph(vertex_count, edge_from, edge_to, edge_length, edge_fid)
+
+
+def make_graph():
+    #  0 --1-- 1 --1-- 2
+    #   \             /
+    #    ----5--------
+    #  3 (isolated)
+    lines = [(0, 1, 1.0, 10), (1, 2, 1.0, 11), (0, 2, 5.0, 12)]
+    return graph_from_lines(lines, 4)
+
+
+def test_csr_layout():
+    graph = make_graph()
+    assert graph.edge_count == 6
+    assert graph.offsets.tolist() == [0, 2, 4, 6, 6]
+    for v in range(graph.vertex_count):
+        edges = graph.edges[graph.offsets[v] : graph.offsets[v + 1]]
+        assert np.all(graph.edge_from[edges] == v)
+
+
+def test_dijkstra():
+    graph = make_graph()
+    tree, cost = dijkstra(graph, 0)
+    assert cost[:3].tolist() == [0.0, 1.0, 2.0]
+    assert math.isinf(cost[3])
+    assert tree[0] == -1 and tree[3] == -1
+    # Vertex 2 is reached through vertex 1, not the direct long edge
+    assert graph.edge_from[tree[2]] == 1
+    assert graph.edge_fid[tree[2]] == 11
+
+
+def test_dijkstra_cutoff():
+    graph = make_graph()
+    tree, cost = dijkstra(graph, 0, cutoff=1.5)
+    assert cost[1] == 1.0
+    assert tree[2] == -1 and math.isinf(cost[2])
+
+
+def test_connected_components():
+    assert connected_components(make_graph()).tolist() == [0, 0, 0, 3]
+    # A path numbered from both ends towards the middle, and a one way edge
+    edge_from = [0, 2, 4, 3, 5]
+    edge_to = [2, 4, 3, 1, 6]
+    graph = Graph(7, edge_from, edge_to, np.ones(5), np.zeros(5))
+    assert connected_components(graph).tolist() == [0, 0, 0, 0, 0, 5, 5]
+
+
+def test_tree_depth():
+    parent = np.array([-1, 0, 1, 1, -1, 2])
+    assert tree_depth(parent).tolist() == [0, 1, 2, 2, 0, 3]
+
+
+def test_tree_flows():
+    # Feature 20 is split in two graph edges at vertex 4
+    lines = [(0, 1, 1.0, 10), (1, 4, 1.0, 20), (4, 2, 1.0, 20), (1, 3, 1.0, 30)]
+    graph = graph_from_lines(lines, 5)
+
+    tree, cost = dijkstra(graph, 0)
+    weights = np.array([[1.0, 0.0], [0.0, 2.0], [4.0, 0.0]])
+    edges, flows = tree_flows(graph, tree, np.array([2, 3, 4]), weights)
+
+    fid_flows = dict(zip(graph.edge_fid[edges].tolist(), flows.tolist()))
+    assert fid_flows == {10: [5.0, 2.0], 20: [5.0, 0.0], 30: [0.0, 2.0]}
+
+
+def test_tree_paths():
+    graph = make_graph()
+    tree, cost = dijkstra(graph, 0)
+    paths, edges = tree_paths(graph, tree, np.array([2, 0, 1]))
+    assert graph.edge_fid[edges[paths == 0]].tolist() == [11, 10]
+    assert not np.any(paths == 1)
+    assert graph.edge_fid[edges[paths == 2]].tolist() == [10]
+
+
+def test_build_graph():
+    # Feature 1: (0, 0) - (2, 0) - (2, 2), feature 2: (2, 2) - (4, 2)
+    segment_xy = [(0, 0, 2, 0), (2, 0, 2, 2), (2, 2, 4, 2)]
+    segment_fid = [1, 1, 2]
+    segment_index = [0, 1, 0]
+    # Points tied to the middle of the first segment and of feature 2
+    graph, tied = build_graph(
+        segment_xy, segment_fid, segment_index, [0, 2], [(1, 0), (3, 2)]
+    )
+    assert graph.vertex_count == 6
+    assert graph.edge_count == 10
+    assert graph.vertex_xy[tied].tolist() == [[1, 0], [3, 2]]
+
+    tree, cost = dijkstra(graph, tied[0])
+    assert cost[tied[1]] == 4.0
+    route = []
+    v = tied[1]
+    while v != tied[0]:
+        route.append((graph.edge_fid[tree[v]], graph.edge_segment[tree[v]]))
+        v = graph.edge_from[tree[v]]
+    assert route == [(2, 0), (1, 1), (1, 0)]
+
+
+def test_contraction():
+    # 0 - 1 - 2 - 3 - 4 with a branch 2 - 5, and 3 tied to a point
+    lines = [(0, 1, 1.0, 10), (1, 2, 2.0, 11), (2, 3, 1.0, 12)]
+    lines += [(3, 4, 1.0, 13), (2, 5, 4.0, 14)]
+    graph = graph_from_lines(lines, 6)
+
+    contraction = Contraction.from_graph(graph, protected=[3])
+    assert contraction.vertices.tolist() == [0, 2, 3, 4, 5]
+    assert contraction.graph.edge_count == 8
+    # The chain from 0 to 2 keeps the fids it runs along
+    chain = np.flatnonzero(contraction.graph.edge_from == 0)[0]
+    edges = contraction.chain_edges[
+        contraction.chain_ptr[chain] : contraction.chain_ptr[chain + 1]
+    ]
+    assert graph.edge_fid[edges].tolist() == [10, 11]
+    assert contraction.graph.edge_length[chain] == 3.0
+
+    for source in (0, 3):
+        tree, cost = contraction.dijkstra(graph, source)
+        expected_tree, expected_cost = dijkstra(graph, source)
+        assert tree.tolist() == expected_tree.tolist()
+        assert cost.tolist() == expected_cost.tolist()
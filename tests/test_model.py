@@ -0,0 +1,57 @@
+import math
+
+import numpy as np
+
+from bicycle_planner.model import CATEGORIES, Model
+from bicycle_planner.params import (
+    MAX_DISTANCE_M,
+    mode_params_bike,
+    mode_split,
+    poi_gravity_values,
+    trip_generation,
+)
+
+
+def test_model_flows():
+    model = Model()
+    work = CATEGORIES.index('work')
+    shopping = CATEGORIES.index('shopping')
+    cats = np.array([work, work, shopping])
+    distances = np.array([1000.0, 5000.0, 2000.0])
+    sizes = np.array([10.0, 20.0, 1.0])
+
+    decay, decay_sums, p_mode = model.evaluate(cats, distances, sizes)
+    assert decay[0] == 10.0 * math.exp(poi_gravity_values['work'])
+    assert decay_sums[work] == decay[0] + decay[1]
+    assert decay_sums[shopping] == decay[2]
+
+    b0, b1, b2, b3 = mode_params_bike['work']
+    d = 1000.0 / MAX_DISTANCE_M
+    p_bike = 1 / (1 + math.exp(-(b0 + b1 * d + b2 * d**2 + b3 * math.sqrt(d))))
+    assert math.isclose(p_mode[0, 0], p_bike)
+
+    flows = model.flows(cats, distances, sizes, 100.0)
+    expected = (
+        mode_split['bike']
+        * trip_generation['work']
+        * 100.0
+        * p_bike
+        * decay[0]
+        / decay_sums[work]
+    )
+    assert math.isclose(flows[0, 0], expected)
+
+
+def test_cutoffs():
+    model = Model()
+    loose = model.cutoffs(1e-4, MAX_DISTANCE_M)
+    tight = model.cutoffs(1e-2, MAX_DISTANCE_M)
+    assert loose.shape == (len(CATEGORIES),)
+    assert np.all(tight <= loose)
+    assert np.all(loose <= MAX_DISTANCE_M)
+
+    full = np.full(len(CATEGORIES), MAX_DISTANCE_M)
+    assert np.allclose(model.truncation_error(full, MAX_DISTANCE_M), 0)
+    pruned = tight < MAX_DISTANCE_M
+    assert np.any(pruned)
+    assert np.all(model.truncation_error(tight, MAX_DISTANCE_M)[pruned] != 0)
@@ -0,0 +1,25 @@
+import numpy as np
+
+from bicycle_planner.odmatrix import OdMatrix, load_od_matrix, save_od_matrix
+
+
+def test_od_matrix(tmp_path):
+    # Pairs of origins 2 and 0 (in that order), origin 1 reaches nothing
+    pairs = [
+        (np.array([2, 2]), np.array([1, 0]), np.array([300.0, 200.0])),
+        (np.array([0]), np.array([1]), np.array([100.0])),
+    ]
+    od_matrix = OdMatrix.from_pairs(pairs, [10, 11, 12], [20, 21], np.array([0, 3]))
+    assert od_matrix.orig_ptr.tolist() == [0, 1, 1, 3]
+
+    save_od_matrix(str(tmp_path), od_matrix)
+    od_matrix = load_od_matrix(str(tmp_path))
+    assert isinstance(od_matrix.distances, np.memmap)
+    dest, distances = od_matrix.origin(2)
+    assert dest.tolist() == [1, 0]
+    assert distances.tolist() == [300.0, 200.0]
+    assert len(od_matrix.origin(1)[0]) == 0
+
+    orig_ids, dest_ids, distances = od_matrix.to_coo()
+    assert orig_ids.tolist() == [10, 12, 12]
+    assert dest_ids.tolist() == [21, 21, 20]
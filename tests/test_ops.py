@@ -2,6 +2,8 @@ import os.path
 import sys
 import csv
 
+import numpy as np
+
 from devtools import debug
 from qgis.core import QgsVectorLayer, QgsWkbTypes, QgsApplication
 
@@ -38,7 +40,7 @@ def test_foo_bar_baz(datadir, qgis_processing):
             index_field = header.index('Index')
             socio_data = {row[0]: float(row[index_field]) for row in reader}
 
-    features, bike_v, ebke_v = generate_od_routes(
+    features, bike_v, ebke_v, routes = generate_od_routes(
         network_layer=network_layer,
         origin_layer=deso_layer,
         poi_layer=poi_layer,
@@ -50,3 +52,9 @@ def test_foo_bar_baz(datadir, qgis_processing):
         return_layer=False,
         return_raw=True,
     )
+
+    # The routes reproduce the flows through their incidence matrix
+    assert routes.incidence.shape == (len(routes), len(network_layer))
+    bike_flows, ebike_flows = routes.evaluate()
+    assert np.allclose(bike_flows, bike_v)
+    assert np.allclose(ebike_flows, ebke_v)
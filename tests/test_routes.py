@@ -0,0 +1,212 @@
+import numpy as np
+
+from bicycle_planner.graph import Graph, dijkstra
+from bicycle_planner.model import CATEGORIES, Model
+from bicycle_planner.parallel import route_origins_parallel
+from bicycle_planner.routes import (
+    Incidence,
+    Routes,
+    load_network_fids,
+    load_routes,
+    save_routes,
+)
+from bicycle_planner.routing import (
+    OdData,
+    aggregate_destinations,
+    candidates,
+    reverse_categories,
+    route_destinations,
+    route_origins,
+)
+
+from .test_graph import graph_from_lines
+
+
+def make_od():
+    # A 3 x 3 grid with one network feature per edge
+    pairs = [(v, v + 1) for v in range(9) if v % 3 != 2]
+    pairs += [(v, v + 3) for v in range(6)]
+    lines = [(a, b, 1000.0, fid) for fid, (a, b) in enumerate(pairs)]
+    graph = graph_from_lines(lines, 9)
+
+    od = OdData(
+        orig_xy=np.zeros((2, 2)),
+        orig_vertex_ids=np.array([0, 4]),
+        orig_sizes=np.array([10.0, 20.0]),
+        dest_xy=np.zeros((4, 2)),
+        dest_vertex_ids=np.array([8, 2, 6, 4]),
+        dest_sizes=np.array([1.0, 2.0, 3.0, 1.0]),
+        dest_cats=np.array([0, 0, 1, len(CATEGORIES) - 1]),
+    )
+    return graph, od, graph.edge_fid, len(lines)
+
+
+def test_incidence_assign():
+    # Route 0 passes rows 0 and 2, route 1 rows 1 and 2
+    incidence = Incidence(np.array([0, 2, 4]), np.array([0, 2, 1, 2]), (2, 3))
+    assert incidence.assign([1.0, 2.0]).tolist() == [1.0, 2.0, 3.0]
+    assert incidence.assign([[1.0, 2.0], [0.0, 1.0]]).tolist() == [
+        [1.0, 2.0, 3.0],
+        [0.0, 1.0, 1.0],
+    ]
+    flows = incidence.assign([1.0, 2.0], columns=np.array([1, 0]), column_n=2)
+    assert flows.tolist() == [[0.0, 2.0, 2.0], [1.0, 0.0, 1.0]]
+
+
+def test_routes_evaluate(tmp_path):
+    graph, od, edge_row, row_n = make_od()
+    parts = []
+    flows = route_origins(graph, od, range(2), edge_row, row_n, routes=parts)
+    routes = Routes.concatenate(parts, row_n)
+    # Destinations at the origin vertex are not in its tree
+    assert len(routes) == 7
+    assert sorted(np.diff(routes.row_ptr)) == [2, 2, 2, 2, 2, 2, 4]
+    assert np.allclose(routes.evaluate(), flows)
+
+    fids = np.arange(row_n) + 100
+    save_routes(str(tmp_path), routes, fids)
+    model = Model(mode_split={'bike': 0.5, 'ebike': 0.5})
+    flows = route_origins(graph, od, range(2), edge_row, row_n, model=model)
+    assert np.allclose(load_routes(str(tmp_path)).evaluate(model), flows)
+
+    # The same features read in reverse order
+    assert load_network_fids(str(tmp_path)).tolist() == fids.tolist()
+    reordered = load_routes(str(tmp_path)).reorder(fids, fids[::-1])
+    assert np.allclose(reordered.evaluate(model), flows[:, :, ::-1])
+
+
+def test_route_origins_parallel():
+    graph, od, edge_row, row_n = make_od()
+    # Origins 0 and 2 share a tree and must end up in one chunk
+    od = od._replace(
+        orig_xy=np.zeros((4, 2)),
+        orig_vertex_ids=np.array([4, 0, 4, 1]),
+        orig_sizes=np.array([20.0, 10.0, 5.0, 8.0]),
+    )
+    parts = []
+    pairs = []
+    flows = route_origins(
+        graph, od, range(4), edge_row, row_n, routes=parts, od_pairs=pairs
+    )
+    parallel_parts = []
+    parallel_pairs = []
+    parallel_flows = route_origins_parallel(
+        graph,
+        od,
+        edge_row,
+        row_n,
+        routes=parallel_parts,
+        od_pairs=parallel_pairs,
+        workers=2,
+        chunk_size=1,
+    )
+    assert np.allclose(parallel_flows, flows)
+    routes = Routes.concatenate(parallel_parts, row_n)
+    assert len(routes) == len(Routes.concatenate(parts, row_n))
+    assert np.allclose(routes.evaluate(), flows)
+
+    def sorted_pairs(od_pairs):
+        origs, dests, distances = (np.concatenate(a) for a in zip(*od_pairs))
+        order = np.lexsort((dests, origs))
+        return origs[order], dests[order], distances[order]
+
+    for parallel, serial in zip(sorted_pairs(parallel_pairs), sorted_pairs(pairs)):
+        assert np.allclose(parallel, serial)
+
+
+def test_candidates_batches():
+    rng = np.random.default_rng(0)
+    graph, od, edge_row, row_n = make_od()
+    od = od._replace(
+        orig_xy=rng.random((200, 2)) * 1000.0, dest_xy=rng.random((500, 2)) * 1000.0
+    )
+    origins = list(range(200))
+    expected = [dests.tolist() for dests in candidates(od, origins, 150.0)]
+    assert sum(map(len, expected)) > 0
+    # Batches of one origin, and of a few
+    for batch_size in (1, 100):
+        found = [dests.tolist() for dests in candidates(od, origins, 150.0, batch_size)]
+        assert found == expected
+
+
+def test_aggregate_destinations():
+    graph, od, edge_row, row_n = make_od()
+    # Split the destination at vertex 8 in two and add one without a size
+    split = od._replace(
+        dest_xy=np.zeros((6, 2)),
+        dest_vertex_ids=np.array([8, 2, 6, 4, 8, 2]),
+        dest_sizes=np.array([0.25, 2.0, 3.0, 1.0, 0.75, 0.0]),
+        dest_cats=np.array([0, 0, 1, len(CATEGORIES) - 1, 0, 0]),
+    )
+    vertices, cats, sizes = aggregate_destinations(split, np.arange(6))
+    assert vertices.tolist() == [2, 4, 6, 8]
+    assert sizes.tolist() == [2.0, 1.0, 3.0, 1.0]
+
+    flows = route_origins(graph, od, range(2), edge_row, row_n)
+    assert np.allclose(route_origins(graph, split, range(2), edge_row, row_n), flows)
+    assert np.allclose(
+        route_origins(graph, split, range(2), edge_row, row_n, max_distance=1.0),
+        flows,
+    )
+
+
+def test_origins_share_tree():
+    graph, od, edge_row, row_n = make_od()
+    od = od._replace(
+        orig_xy=np.array([(0.0, 0.0), (0.0, 0.0), (500.0, 0.0)]),
+        orig_vertex_ids=np.array([4, 0, 4]),
+        orig_sizes=np.array([20.0, 10.0, 5.0]),
+    )
+    trees = []
+
+    def shortest_paths(vertex_id):
+        trees.append(vertex_id)
+        return dijkstra(graph, vertex_id)
+
+    for max_distance in (np.inf, 2000.0):
+        trees.clear()
+        flows = route_origins(
+            graph, od, range(3), edge_row, row_n, max_distance, np.inf, shortest_paths
+        )
+        assert sorted(trees) == [0, 4]
+        expected = sum(
+            route_origins(graph, od, [i], edge_row, row_n, max_distance)
+            for i in range(3)
+        )
+        assert np.allclose(flows, expected)
+
+
+def test_route_destinations():
+    graph, od, edge_row, row_n = make_od()
+    # Unique shortest paths, so that both directions take the same routes
+    graph = Graph(
+        graph.vertex_count,
+        graph.edge_from,
+        graph.edge_to,
+        1000.0 + 37.0 * graph.edge_fid,
+        graph.edge_fid,
+    )
+    od = od._replace(
+        orig_xy=np.array([(0.0, 0.0), (0.0, 0.0), (500.0, 0.0)]),
+        orig_vertex_ids=np.array([0, 3, 7]),
+        orig_sizes=np.array([20.0, 10.0, 5.0]),
+    )
+    for max_distance in (np.inf, 10.0):
+        flows = route_origins(graph, od, range(3), edge_row, row_n, max_distance)
+        assert np.allclose(
+            route_destinations(graph, od, edge_row, row_n, max_distance), flows
+        )
+
+
+def test_reverse_categories():
+    graph, od, edge_row, row_n = make_od()
+    assert not np.any(reverse_categories(od))
+    od = od._replace(
+        orig_vertex_ids=np.arange(9),
+        orig_sizes=np.ones(9),
+        dest_vertex_ids=np.array([8, 8, 6, 4]),
+    )
+    # Category 0 at vertex 8, 1 at vertex 6 and the last at vertex 4
+    assert reverse_categories(od).tolist() == [True, True] + [False] * (
+        len(CATEGORIES) - 3
+    ) + [True]
@@ -0,0 +1,60 @@
+import numpy as np
+
+from bicycle_planner.spatial import GridIndex, project_to_segments, snap_to_segments
+
+
+def test_grid_index_query():
+    rng = np.random.default_rng(0)
+    points = rng.random((2000, 2)) * 1000.0
+    queries = rng.random((50, 2)) * 1200.0 - 100.0
+
+    for cell_size in (100.0, 40.0):
+        ptr, indices = GridIndex(points, cell_size).query(queries, 100.0)
+        for i, query in enumerate(queries):
+            distances = np.hypot(*(points - query).T)
+            expected = np.flatnonzero(distances <= 100.0)
+            assert indices[ptr[i] : ptr[i + 1]].tolist() == expected.tolist()
+
+
+def test_grid_index_no_limit():
+    # All points in one cell are found, however many there are
+    points = np.zeros((10000, 2))
+    ptr, indices = GridIndex(points, 10.0).query([(1.0, 1.0)], 10.0)
+    assert ptr.tolist() == [0, 10000]
+
+
+def test_grid_index_candidate_counts():
+    rng = np.random.default_rng(0)
+    points = rng.random((2000, 2)) * 1000.0
+    queries = rng.random((50, 2)) * 1200.0 - 100.0
+    index = GridIndex(points, 100.0)
+    counts = index.candidate_counts(queries, 100.0)
+
+    ptr, indices = index.query(queries, 100.0)
+    assert np.all(counts >= np.diff(ptr))
+    # The points of the 3 x 3 cells around each query point
+    cells = np.floor((queries - index.origin) / 100.0)
+    point_cells = np.floor((points - index.origin) / 100.0)
+    expected = [
+        np.sum(np.all(np.abs(point_cells - cell) <= 1, axis=1)) for cell in cells
+    ]
+    assert counts.tolist() == expected
+
+
+def test_snap_to_segments():
+    rng = np.random.default_rng(0)
+    start = rng.random((500, 2)) * 1000.0
+    segment_xy = np.hstack((start, start + rng.normal(0.0, 30.0, (500, 2))))
+    # A long segment crossing many cells and points far outside the network
+    segment_xy[0] = (0.0, 0.0, 1000.0, 1000.0)
+    points = rng.random((300, 2)) * 1400.0 - 200.0
+    points[0] = (5000.0, -3000.0)
+
+    for cell_size in (None, 5.0):
+        point_segment, point_xy = snap_to_segments(segment_xy, points, cell_size)
+        for i, point in enumerate(points):
+            closest, d2 = project_to_segments(
+                segment_xy, np.broadcast_to(point, (len(segment_xy), 2))
+            )
+            assert point_segment[i] == np.argmin(d2)
+            assert np.allclose(point_xy[i], closest[np.argmin(d2)])